@@ -0,0 +1,117 @@
+# Wall-clock time of sjk.batch on a set of identical CPU-bound scripts,
+# with 1, 2, 4, ... jobs up to the number of cores. Each script runs in
+# its own CAS process, so with enough scripts the speedup over one job
+# should stay close to the number of jobs until the cores run out.
+#
+#   python benchmarks/batch_scaling.py singular [-n 32] [--code CELL]
+#                                       [--max-jobs N]
+#
+# "stand-in" is a Python process that evaluates each line as a CAS would,
+# for measuring the runner itself where no CAS is installed.
+#
+# With the stand-in, on a one-core VM (so CPU-bound scripts cannot speed
+# up; this shows the runner's own overhead and overlap):
+#
+#   stand-in -n 16 --max-jobs 8 (CPU-bound, 0.13 s a script)
+#     1 jobs: 16 scripts in    2.16 s, speedup  1.00
+#     8 jobs: 16 scripts in    2.18 s, speedup  0.99
+#   stand-in -n 16 --max-jobs 16 --code 'import time; time.sleep(1)'
+#     1 jobs: 16 scripts in   16.24 s, speedup  1.00
+#     2 jobs: 16 scripts in    8.16 s, speedup  1.99
+#     4 jobs: 16 scripts in    4.14 s, speedup  3.93
+#     8 jobs: 16 scripts in    2.14 s, speedup  7.59
+#    16 jobs: 16 scripts in    1.15 s, speedup 14.11
+#
+# More jobs than cores cost nothing measurable, and the runner overlaps
+# its processes almost fully, so CPU-bound scripts should scale with the
+# cores of the host. Numbers for a real CAS need a host with more cores.
+
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sjk import backends, batch
+from sjk.cas_kernel import CasConfig
+
+stand_in = r"""
+import sys
+env = {}
+for line in sys.stdin:
+    line = line.strip()
+    if line == '"→"':
+        sys.stdout.write("→")
+        sys.stdout.flush()
+    elif line:
+        try:
+            result = eval(line, env)
+        except SyntaxError:
+            exec(line, env)
+            result = None
+        if result is not None:
+            print(result, flush=True)
+"""
+
+class StandInConfig(CasConfig):
+
+    name = "stand-in"
+    cmd = [ sys.executable, "-c", stand_in ]
+
+# a few seconds of work in one cell, and a cell printing its result
+scripts = {
+    'gap': "s := 0;; for i in [1..3000000] do s := s + i mod 7; od;\n\ns;\n",
+    'singular': "int s; int i;\nfor (i = 1; i <= 1000000; i++) "
+                "{ s = s + i mod 7; }\n\ns;\n",
+    'macaulay2': "s = 0; for i from 1 to 3000000 do s = s + i % 7;\n\ns\n",
+    'asir': "S = 0$\nfor (I = 1; I <= 3000000; I++) S += I % 7$\n\nS;\n",
+    'stand-in': "s = sum(i % 7 for i in range(3000000))\n\ns\n",
+}
+
+def run(backend, paths, jobs):
+    with open(os.devnull, "w") as out:
+        runner = batch.BatchRunner(out, jobs, backend)
+        if backend == StandInConfig.name:
+            runner.configs[backend] = StandInConfig
+        elapsed = asyncio.run(runner.run(paths))
+    return elapsed, runner
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("backend", choices=sorted(backends.configs)
+                                           + [StandInConfig.name])
+    parser.add_argument("-n", "--scripts", type=int, default=32)
+    parser.add_argument("--code", help="script to run (default: a loop)")
+    parser.add_argument("--max-jobs", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    code = args.code or scripts.get(args.backend)
+    if code is None:
+        parser.error("no default script for {}: use --code".format(
+            args.backend))
+    tmp = tempfile.mkdtemp()
+    try:
+        paths = []
+        for n in range(args.scripts):
+            paths.append(os.path.join(tmp, "script{}.txt".format(n)))
+            with open(paths[-1], "w") as f:
+                f.write(code)
+        jobs = 1
+        base = None
+        while True:
+            elapsed, runner = run(args.backend, paths, jobs)
+            base = base or elapsed
+            print("{:>3} jobs: {} scripts in {:7.2f} s, speedup {:5.2f} "
+                  "({} failed)".format(jobs, args.scripts, elapsed,
+                                       base / elapsed, runner.failed))
+            if jobs >= args.max_jobs:
+                break
+            jobs = min(2 * jobs, args.max_jobs)
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
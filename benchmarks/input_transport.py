@@ -0,0 +1,93 @@
+# Time from sending a cell of pasted data to the next prompt, with the
+# cell sent inline on stdin and loaded from the intermediate file, for
+# the backends that can do either (file_input_threshold is set). The
+# smallest size at which the file is consistently faster is a good
+# file_input_threshold for that backend and machine; it can also be set
+# per kernel with SJK_FILE_INPUT_THRESHOLD.
+#
+#   python benchmarks/input_transport.py gap [-r REPEAT] [SIZE...]
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sjk import backends
+from sjk.cas_kernel import REPL
+
+# a cell of the given size that assigns a list of integers
+templates = {
+    'gap': "data := [ {} ];;\n",
+    'macaulay2': "data = { {} };\n",
+}
+
+def make_cell(template, size):
+    items = []
+    length = len(template)
+    while length < size:
+        item = str(1000003 * len(items) % 99991)
+        items.append(item)
+        length += len(item) + 2
+        if len(items) % 16 == 0:
+            items[-1] += "\n"
+    return template.replace("{}", ", ".join(items))
+
+def run_cell(config, child, reader, cell):
+    started = time.perf_counter()
+    text, err = REPL.prepare_input(config, cell)
+    if text is None:
+        sys.exit("cell rejected: {}".format(err))
+    child.stdin.write(text)
+    child.stdin.flush()
+    if not REPL.skip_output(reader):
+        sys.exit("{} exited".format(config.name))
+    return time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("backend")
+    parser.add_argument("sizes", nargs="*", type=int,
+                        default=[ 1024 * 4**k for k in range(8) ])
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("--template",
+                        help="cell with {} where the list items go")
+    args = parser.parse_args()
+
+    config = backends.get_config(args.backend)
+    template = args.template or templates.get(args.backend)
+    if config.file_input_threshold is None or template is None:
+        sys.exit("{} has no file input transport".format(args.backend))
+    os.environ.pop("SJK_FILE_INPUT_THRESHOLD", None)
+    child, reader = REPL.boot(config)
+    if child is None:
+        sys.exit("could not start {}".format(args.backend))
+
+    print("{:>10} {:>12} {:>12}   (milliseconds, best of {})".format(
+        "bytes", "inline", "file", args.repeat))
+    crossover = None
+    try:
+        for size in args.sizes:
+            cell = make_cell(template, size)
+            best = []
+            for threshold in [ len(cell) + 1, 0 ]:
+                config.file_input_threshold = threshold
+                best.append(min(run_cell(config, child, reader, cell)
+                                for i in range(args.repeat)))
+            inline, loaded = best
+            if loaded < inline:
+                crossover = crossover or size
+            else:
+                crossover = None
+            print("{:>10} {:>12.2f} {:>12.2f}".format(
+                size, inline * 1e3, loaded * 1e3))
+    finally:
+        child.kill()
+    if crossover is None:
+        print("inline input was never consistently slower")
+    else:
+        print("file_input_threshold = {}".format(crossover))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# Per-cell cost of handing a cell to a backend through a file (Singular,
+# Asir, Mathematica): the kernel writes the cell and the CAS opens and
+# reads it. "tempfile" is the old path, one NamedTemporaryFile per cell;
+# the others are sjk.cas_kernel.IntermediateFile, reused across cells.
+#
+#   python benchmarks/intermediate_file.py [-n CELLS] [--dir DIR] [SIZE...]
+#
+# Point --dir at e.g. an NFS home to see the cost of the old path there.
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sjk.cas_kernel import IntermediateFile
+
+def load(name):
+    with open(name, encoding="utf8") as f:
+        return f.read()
+
+def per_tempfile(code, cells, directory):
+    started = time.perf_counter()
+    for i in range(cells):
+        f = tempfile.NamedTemporaryFile('w+', dir=directory)
+        f.write(code)
+        f.flush()
+        load(f.name)
+        f.close()
+    return (time.perf_counter() - started) / cells
+
+def per_intermediate(code, cells, kind):
+    f = IntermediateFile(kind)
+    started = time.perf_counter()
+    for i in range(cells):
+        f.write(code)
+        load(f.name)
+    elapsed = time.perf_counter() - started
+    f.close()
+    return elapsed / cells
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sizes", nargs="*", type=int,
+                        default=[ 16, 1024, 65536, 1048576 ])
+    parser.add_argument("-n", "--cells", type=int, default=2000)
+    parser.add_argument("--dir", default=None,
+                        help="directory for the tempfile path")
+    args = parser.parse_args()
+
+    kinds = [ "memfd", "shm", "tmp" ]
+    print("{:>10} {:>12}".format("bytes", "tempfile") +
+          "".join("{:>12}".format(kind) for kind in kinds) +
+          "   (microseconds per cell)")
+    for size in args.sizes:
+        code = ("x;\n" * (size // 3 + 1))[:size]
+        cells = max(10, args.cells * 1024 // max(size, 1024))
+        row = [ per_tempfile(code, cells, args.dir) ]
+        row += [ per_intermediate(code, cells, kind) for kind in kinds ]
+        print("{:>10}".format(size) +
+              "".join("{:>12.1f}".format(t * 1e6) for t in row))
+
+if __name__ == '__main__':
+    main()
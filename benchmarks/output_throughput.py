@@ -0,0 +1,126 @@
+# Output throughput of a cell that prints a lot: a stand-in CAS prints the
+# requested number of bytes of text lines and then the prompt. "old" is
+# the reader sjk had before OutputReader, one read(1) per character with
+# the segment grown by concatenation; it is quadratic, so it only runs up
+# to --old-max MB.
+#
+#   python benchmarks/output_throughput.py [--old-max MB] [MB...]
+#
+# On a one-core Xeon VM with Python 3.11:
+#
+#       MB       old (MB/s)      REPL (MB/s) AsyncREPL (MB/s)
+#     0.25              0.3            149.2            265.2
+#        1                -            210.6            375.5
+#        4                -            232.2            405.2
+#       32                -            220.2            340.4
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sjk.cas_kernel import CasConfig, REPL, AsyncREPL
+
+printer = r"""
+import sys
+line = "x" * 79 + "\n"
+for request in sys.stdin:
+    request = request.strip()
+    if request == '"→"':
+        sys.stdout.write("→")
+    elif request:
+        sys.stdout.write(line * (int(request) // len(line)))
+    sys.stdout.flush()
+"""
+
+class PrinterConfig(CasConfig):
+
+    name = "printer"
+    cmd = [ sys.executable, "-c", printer ]
+    output_budget = 2**34
+    accounting = False
+
+def old_reader(size):
+    child = subprocess.Popen(PrinterConfig.cmd, stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, encoding="utf8")
+    try:
+        def read_output():
+            output = [""]
+            idx = 0
+            while True:
+                c = child.stdout.read(1)
+                if not c:
+                    return output
+                output[idx] += c
+                if output[idx][-1] == PrinterConfig.prompt_char:
+                    output[idx] = output[idx][:-1]
+                    return output
+        child.stdin.write(PrinterConfig.initial_input)
+        child.stdin.flush()
+        read_output()
+        started = time.perf_counter()
+        child.stdin.write(PrinterConfig.input_cmd(1, str(size), None))
+        child.stdin.flush()
+        received = len(read_output()[0])
+        return received, time.perf_counter() - started
+    finally:
+        child.kill()
+        child.wait()
+
+async def run_cell(repl, num, size):
+    started = time.perf_counter()
+    repl.submit(num, str(size))
+    received = 0
+    while True:
+        num, kind, payload = await repl.get_output()
+        if kind == "stream":
+            received += len(payload)
+        elif kind == "ok":
+            received += sum(len(output) for output in payload)
+            return received, time.perf_counter() - started
+        elif kind not in ("usage", "timings", "notice"):
+            raise RuntimeError("{}: {}".format(kind, payload))
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sizes", nargs="*", type=float,
+                        default=[0.25, 1, 4, 32], help="output in MB")
+    parser.add_argument("--old-max", type=float, default=0.25,
+                        help="largest output to read with the old reader")
+    args = parser.parse_args()
+
+    sizes = [ int(mb * 2**20) for mb in args.sizes ]
+    rates = { size: {} for size in sizes }
+    for size in sizes:
+        if size <= args.old_max * 2**20:
+            received, elapsed = old_reader(size)
+            rates[size]['old'] = received / 2**20 / elapsed
+    for driver in [ REPL, AsyncREPL ]:
+        repl = driver(PrinterConfig)
+        repl.start()
+        try:
+            # once the child is up
+            await run_cell(repl, 0, 0)
+            for num, size in enumerate(sizes, 1):
+                received, elapsed = await run_cell(repl, num, size)
+                rates[size][driver.__name__] = received / 2**20 / elapsed
+        finally:
+            if driver is REPL:
+                repl.proc.kill()
+            else:
+                repl.kill()
+    columns = ["old", "REPL", "AsyncREPL"]
+    print("{:>8}".format("MB") + "".join("{:>17}".format(column + " (MB/s)")
+                                         for column in columns))
+    for size in sizes:
+        print("{:>8g}".format(size / 2**20) + "".join(
+            "{:>17.1f}".format(rates[size][column])
+            if column in rates[size] else "{:>17}".format("-")
+            for column in columns))
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,79 @@
+# Pushes a cell of several MB through a stand-in CAS that echoes every
+# line as soon as it reads it, so that the kernel has to read output
+# while it is still writing input. Fails if a driver stalls for longer
+# than the timeout.
+#
+#   python benchmarks/pipe_stress.py [-m MB] [--timeout SECONDS]
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sjk.cas_kernel import CasConfig, REPL, AsyncREPL
+
+echo = r"""
+import sys
+for line in sys.stdin:
+    if line.strip() == '"→"':
+        sys.stdout.write("→")
+        sys.stdout.flush()
+    else:
+        sys.stdout.write(line)
+"""
+
+class EchoConfig(CasConfig):
+
+    name = "echo"
+    cmd = [ sys.executable, "-c", echo ]
+    stream_delay = 0.1
+    output_budget = 2**30
+
+async def run_cell(repl, code, timeout):
+    repl.submit(1, code)
+    received = 0
+    while True:
+        num, kind, payload = await asyncio.wait_for(repl.get_output(), timeout)
+        if kind == "stream":
+            received += len(payload)
+        elif kind == "ok":
+            return received + sum(len(output) for output in payload)
+        elif kind not in ("usage", "timings", "notice"):
+            raise RuntimeError("{}: {}".format(kind, payload))
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--megabytes", type=float, default=8)
+    parser.add_argument("--timeout", type=float, default=10,
+                        help="longest silence allowed, in seconds")
+    args = parser.parse_args()
+
+    line = "x" * 99 + "\n"
+    code = line * int(args.megabytes * 2**20 / len(line))
+    failed = False
+    for driver in [ REPL, AsyncREPL ]:
+        repl = driver(EchoConfig)
+        repl.start()
+        started = time.monotonic()
+        try:
+            received = await run_cell(repl, code, args.timeout)
+        except asyncio.TimeoutError:
+            print("{}: stalled".format(driver.__name__))
+            failed = True
+        else:
+            elapsed = time.monotonic() - started
+            print("{}: {:.1f} MB in, {:.1f} MB out, {:.2f} s".format(
+                driver.__name__, len(code) / 2**20, received / 2**20,
+                elapsed))
+        finally:
+            if driver is REPL:
+                repl.proc.kill()
+            else:
+                repl.kill()
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,53 @@
+# Wall-clock time of "Run All" on a notebook of many small cells: all the
+# execute requests are sent at once, as a frontend does, with cell
+# pipelining off (SJK_PIPELINE_DEPTH=0) and on.
+#
+#   python benchmarks/run_all.py sjk-singular [-n 300] [--code 'int i = 1;']
+
+import argparse
+import os
+import time
+
+from jupyter_client.manager import KernelManager
+
+def run_all(kernel_name, cells, code, depth):
+    km = KernelManager(kernel_name=kernel_name)
+    env = dict(os.environ, SJK_PIPELINE_DEPTH=str(depth))
+    km.start_kernel(env=env)
+    kc = km.client()
+    kc.start_channels()
+    try:
+        kc.wait_for_ready(timeout=60)
+        kc.execute_interactive(code, timeout=60)
+        started = time.perf_counter()
+        for i in range(cells):
+            kc.execute(code)
+        statuses = []
+        while len(statuses) < cells:
+            msg = kc.get_shell_msg(timeout=60)
+            if msg['msg_type'] == 'execute_reply':
+                statuses.append(msg['content']['status'])
+        elapsed = time.perf_counter() - started
+    finally:
+        kc.stop_channels()
+        km.shutdown_kernel(now=True)
+    return elapsed, statuses
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("kernel", help="kernelspec name, e.g. sjk-singular")
+    parser.add_argument("-n", "--cells", type=int, default=300)
+    parser.add_argument("--code", default="1+1;")
+    parser.add_argument("--depth", type=int, default=1000)
+    args = parser.parse_args()
+
+    for depth in [ 0, args.depth ]:
+        elapsed, statuses = run_all(args.kernel, args.cells, args.code, depth)
+        failed = len(statuses) - statuses.count("ok")
+        print("pipeline depth {:>3}: {} cells in {:.3f} s "
+              "({:.2f} ms/cell, {} not ok)".format(
+                  depth, args.cells, elapsed, 1e3 * elapsed / args.cells,
+                  failed))
+
+if __name__ == '__main__':
+    main()
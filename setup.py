@@ -13,8 +13,8 @@ sargs = dict(
     author           = 'Roi Docampo',
     url              = 'https://github.com/roidocampo/sjk',
     license          = 'MIT',
-    install_requires = [ 'ipykernel' ],
-    python_requires  = ">=3.5",
+    install_requires = [ 'ipykernel>=6,<7' ],
+    python_requires  = ">=3.7",
 
 )
 
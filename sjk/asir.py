@@ -8,6 +8,7 @@ from .syntax import asir as asir_syntax
 
 class AsirConfig(CasConfig):
 
+    name = "asir"
     prompt_char = "\u2192"
     prompt_cmd = "print(\"{}\",2)$".format(prompt_char)
     cmd = \
@@ -16,6 +17,8 @@ class AsirConfig(CasConfig):
          ]
     initial_input = prompt_cmd + "\n"
     use_intermediate_file = True
+    list_assign_cmd = "{name} = [ {items} ]$"
+    interrupt_input = "t\n" + prompt_cmd + "\n" # "return to toplevel"
 
     @classmethod
     def syntaxchecker(cls, code):
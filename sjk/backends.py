@@ -0,0 +1,15 @@
+import importlib
+
+###########################################################################
+
+configs = {
+    'asir':        'sjk.asir:AsirConfig',
+    'gap':         'sjk.gap:GapConfig',
+    'macaulay2':   'sjk.macaulay2:Macaulay2Config',
+    'mathematica': 'sjk.mathematica:MathematicaConfig',
+    'singular':    'sjk.singular:SingularConfig',
+}
+
+def get_config(name):
+    module, attr = configs[name].split(":")
+    return getattr(importlib.import_module(module), attr)
@@ -0,0 +1,242 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from . import backends
+from .cas_kernel import AsyncREPL
+
+###########################################################################
+
+# Runs CAS scripts without Jupyter: each file is split into cells and run
+# in a fresh CAS process, driven by an AsyncREPL, with up to --jobs files
+# at a time. Every cell gives a JSON line with its output and timing, and
+# every file one more once it is done.
+
+extensions = {
+    '.g':    'gap',
+    '.gap':  'gap',
+    '.sing': 'singular',
+    '.m2':   'macaulay2',
+    '.rr':   'asir',
+    '.wl':   'mathematica',
+    '.wls':  'mathematica',
+}
+
+def split_cells(config, text):
+    # blank line separated paragraphs, joined while the syntax checker
+    # says the cell is incomplete; returns (first line, code) pairs
+    cells = []
+    lines = []
+    start = None
+    for n, line in enumerate(text.splitlines(), 1):
+        if line.strip():
+            if start is None:
+                start = n
+            lines.append(line)
+            continue
+        if start is None:
+            continue
+        code = "\n".join(lines)
+        if config.syntaxchecker(code)[0] == "incomplete":
+            lines.append(line)
+            continue
+        cells.append((start, code))
+        lines = []
+        start = None
+    if start is not None:
+        cells.append((start, "\n".join(lines).rstrip()))
+    return cells
+
+###########################################################################
+
+class BatchRunner(object):
+
+    def __init__(self, out, jobs, backend=None, timeout=None,
+                 stop_on_error=False):
+        self.out = out
+        self.jobs = jobs
+        self.backend = backend
+        self.timeout = timeout
+        self.stop_on_error = stop_on_error
+        self.configs = {}
+        self.files = 0
+        self.failed = 0
+        self.cells = 0
+        self.cell_time = 0.0
+
+    def get_config(self, path):
+        name = self.backend or extensions.get(os.path.splitext(path)[1])
+        if name is None:
+            return None
+        if name not in self.configs:
+            config = backends.get_config(name)
+            if self.timeout is not None:
+                config = type(config.__name__, (config,),
+                              {'cell_timeout': self.timeout})
+            self.configs[name] = config
+        return self.configs[name]
+
+    def emit(self, record):
+        self.out.write(json.dumps(record) + "\n")
+        self.out.flush()
+
+    async def run(self, paths):
+        queue = asyncio.Queue()
+        for path in paths:
+            queue.put_nowait(path)
+        started = time.monotonic()
+        await asyncio.gather(*[ self.worker(queue)
+                                for n in range(min(self.jobs, len(paths))) ])
+        return time.monotonic() - started
+
+    async def worker(self, queue):
+        while not queue.empty():
+            path = queue.get_nowait()
+            record = await self.run_file(path)
+            self.files += 1
+            if record['status'] != "ok":
+                self.failed += 1
+            self.emit(record)
+
+    async def run_file(self, path):
+        record = {'type': 'file', 'file': path, 'backend': None,
+                  'status': "error", 'cells': 0, 'errors': 0, 'time': 0.0}
+        config = self.get_config(path)
+        if config is None:
+            record['error'] = "unknown file type (use --backend)"
+            return record
+        record['backend'] = config.name
+        try:
+            with open(path, encoding="utf8") as f:
+                cells = split_cells(config, f.read())
+        except (OSError, UnicodeDecodeError) as e:
+            record['error'] = str(e)
+            return record
+
+        started = time.monotonic()
+        repl = AsyncREPL(config, start=True)
+        try:
+            errors = await self.run_cells(path, repl, cells)
+        finally:
+            await repl.stop()
+        record['time'] = time.monotonic() - started
+        record['cells'] = len(cells)
+        record['errors'] = errors
+        record['status'] = "error" if errors else "ok"
+        return record
+
+    async def run_cells(self, path, repl, cells):
+        # all cells are submitted at once, and run back to back; a cell's
+        # time is from the end of the previous one (the first one's
+        # includes starting the CAS)
+        for num, (line, code) in enumerate(cells, 1):
+            repl.submit(num, code, 0, self.stop_on_error)
+        outputs = { num: ([], []) for num in range(1, len(cells) + 1) }
+        usages = {}
+        errors = 0
+        last = time.monotonic()
+        num = 1
+        while num <= len(cells):
+            msg_num, kind, payload = await repl.get_output()
+            if msg_num not in outputs:
+                continue
+            text, displays = outputs[msg_num]
+            if kind == "usage":
+                usages[msg_num] = payload
+                continue
+            if kind in ("timings", "notice"):
+                continue
+            if kind == "stream":
+                text.append(payload)
+                continue
+            if kind == "display":
+                displays.append(payload)
+                continue
+            if kind == "ok":
+                text.append(payload[0])
+                displays.extend(payload[1:])
+                error = None
+            else:
+                error = payload
+                errors += 1
+            now = time.monotonic()
+            self.emit_cell(path, msg_num, cells, outputs,
+                           kind if error else "ok", now - last, error,
+                           usages.pop(msg_num, None))
+            self.cells += 1
+            self.cell_time += now - last
+            last = now
+            num = msg_num + 1
+            if error is not None and self.stop_on_error:
+                # the REPL drops the rest
+                for num in range(num, len(cells) + 1):
+                    self.emit_cell(path, num, cells, outputs, "skipped", 0.0)
+                break
+        return errors
+
+    def emit_cell(self, path, num, cells, outputs, status, seconds,
+                  error=None, usage=None):
+        text, displays = outputs.pop(num)
+        self.emit({
+            'type': 'cell',
+            'file': path,
+            'cell': num,
+            'line': cells[num-1][0],
+            'status': status,
+            'time': seconds,
+            'output': "".join(text),
+            'displays': displays,
+            'error': error,
+            'usage': usage,
+        })
+
+###########################################################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m sjk.batch",
+        description="Run CAS scripts cell by cell, in parallel, writing "
+                    "one JSON line per cell and per file.")
+    parser.add_argument("files", nargs="+",
+                        help="scripts; the backend is chosen by extension: "
+                             "{}".format(", ".join(
+                                 "{} ({})".format(ext, name) for ext, name
+                                 in sorted(extensions.items()))))
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="files run at a time (default: one per core)")
+    parser.add_argument("-b", "--backend",
+                        help="run every file with this backend: {}".format(
+                            ", ".join(sorted(backends.configs))))
+    parser.add_argument("-o", "--output",
+                        help="JSON lines file (default: standard output)")
+    parser.add_argument("--timeout", type=float,
+                        help="interrupt cells running longer than this "
+                             "many seconds")
+    parser.add_argument("-x", "--stop-on-error", action="store_true",
+                        help="skip the rest of a file after a failed cell")
+    args = parser.parse_args(argv)
+
+    if args.backend is not None and args.backend not in backends.configs:
+        parser.error("unknown backend: {}".format(args.backend))
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    out = sys.stdout if args.output is None else open(args.output, "w")
+    runner = BatchRunner(out, args.jobs, args.backend, args.timeout,
+                         args.stop_on_error)
+    try:
+        elapsed = asyncio.run(runner.run(args.files))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    sys.stderr.write(
+        "{} files ({} failed), {} cells in {:.2f} s; {:.2f} s of cell time "
+        "on {} jobs\n".format(runner.files, runner.failed, runner.cells,
+                             elapsed, runner.cell_time, args.jobs))
+    sys.exit(1 if runner.failed else 0)
+
+if __name__ == '__main__':
+    main()
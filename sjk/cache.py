@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import tempfile
+
+from . import startup
+
+###########################################################################
+
+def default_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "sjk", "results")
+
+def normalize(config, code):
+    # the cell as the backend's syntax checker sees it, with layout that
+    # does not change what it does taken out; None if it is not complete
+    status, clean, err = config.syntaxchecker(code)
+    if status != "complete":
+        return None
+    if isinstance(clean, list):
+        # top level statements, with their separators
+        return [ [ block.strip(), sep ] for block, sep in clean
+                 if block.strip() or sep != ";" ]
+    return [ line.strip() for line in clean.splitlines() if line.strip() ]
+
+def valid(events):
+    # an entry is a list of [kind, outputs], ending with the cell's result
+    return (isinstance(events, list) and len(events) > 0
+            and all(isinstance(event, list) and len(event) == 2
+                    for event in events)
+            and events[-1][0] == "ok")
+
+###########################################################################
+
+class ResultCache(object):
+
+    # Results of %%cached cells, kept on disk across sessions. An entry is
+    # keyed on the backend, its binary (so a new CAS version misses), the
+    # startup preamble (see sjk.startup) and the normalized cell, and holds
+    # what the cell sent to the notebook: the (kind, outputs) messages the
+    # kernel got from the REPL. Reading an entry touches it; once the cache
+    # holds more than max_size bytes the least recently used entries are
+    # removed.
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.binaries = {}
+        # the preamble the session's children start with
+        self.profile = startup.profile_key()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, config, code):
+        cell = normalize(config, code)
+        if cell is None:
+            return None
+        if config.name not in self.binaries:
+            self.binaries[config.name] = startup.binary_key(config)
+        key = json.dumps([config.name, config.cmd,
+                          self.binaries[config.name], self.profile,
+                          cell])
+        return hashlib.sha256(key.encode("utf8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, encoding="utf8") as f:
+                events = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            events = None
+        if not valid(events):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return events
+
+    def put(self, key, events):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".sjk-", dir=self.directory)
+        try:
+            with open(fd, "w", encoding="utf8") as f:
+                json.dump(events, f)
+            os.replace(tmp, self.path(key))
+        except:
+            os.unlink(tmp)
+            raise
+        self.evict()
+
+    def entries(self):
+        # (mtime, size, path) of the entries, oldest first
+        entries = []
+        try:
+            scan = os.scandir(self.directory)
+        except FileNotFoundError:
+            return entries
+        with scan:
+            for entry in scan:
+                if not entry.name.endswith(".json"):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        entries.sort()
+        return entries
+
+    def evict(self):
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+    def clear(self):
+        for mtime, size, path in self.entries():
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def get_stats(self):
+        entries = self.entries()
+        hits, misses = self.hits, self.misses
+        return dict(
+            directory = self.directory,
+            entries = len(entries),
+            size = sum(entry[1] for entry in entries),
+            max_size = self.max_size,
+            hits = hits,
+            misses = misses,
+            hit_rate = hits / (hits + misses) if hits + misses else None)
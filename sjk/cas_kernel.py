@@ -1,16 +1,39 @@
 
+import asyncio
 import atexit
+import codecs
+import collections
+import ctypes
+import hmac
+import inspect
 import json
 import multiprocessing
+import os
+import queue
+import re
+import select
+import shutil
+import signal
 import subprocess
+import sys
 import tempfile
+import threading
+import time
+import uuid
 
+from ipykernel.comm import CommManager
 from ipykernel.kernelbase import Kernel
 
+from . import checkpoint, limits, magics, startup, usage
+from .cache import ResultCache, default_dir
+from .outputs import OutputStore
+from .timings import StageTimings, stage_durations
+
 ###########################################################################
 
 class CasConfig(object):
 
+    name = "bc"
     prompt_char = "\u2192"
     output_separator = None
     prompt_cmd = "\"{}\"\n".format(prompt_char)
@@ -18,9 +41,85 @@ class CasConfig(object):
     initial_input = prompt_cmd
     use_intermediate_file = False
 
+    # on interrupt the child gets interrupt_signal, then interrupt_input,
+    # which must leave any break/error state and print the prompt again;
+    # output is then drained until it has been quiet for interrupt_settle
+    interrupt_signal = signal.SIGINT
+    interrupt_input = prompt_cmd
+    interrupt_settle = 0.1
+
+    # watchdog: a cell running for more than cell_timeout seconds (None: no
+    # limit) is interrupted; a child that has not printed the prompt again
+    # kill_timeout seconds after an interrupt is killed. A child that exits
+    # or is killed is started again; the REPL checks on an idle child every
+    # watch_interval seconds
+    cell_timeout = float(os.environ.get("SJK_CELL_TIMEOUT") or 0) or None
+    kill_timeout = float(os.environ.get("SJK_KILL_TIMEOUT", 10))
+    watch_interval = 1.0
+
+    # partial output is forwarded once a cell has run for stream_delay
+    # seconds, at most every stream_interval seconds (or as soon as
+    # stream_size characters are buffered), keeping back the last
+    # stream_holdback lines for the execute_result
+    stream_delay = 1.0
+    stream_interval = 0.5
+    stream_size = 65536
+    stream_holdback = 1
+
+    # output past output_budget characters in a cell is not sent to the
+    # notebook but written to a file in spill_dir (the kernel makes it a
+    # directory of the session's); the note giving its path is followed by
+    # the last output_tail characters, unless the budget ran out in a
+    # display, which is left out
+    output_budget = int(os.environ.get("SJK_OUTPUT_BUDGET", 2**20))
+    output_tail = 4096
+    spill_dir = os.environ.get("SJK_SPILL_DIR")
+
+    # backends whose input_cmd can load a large cell from the intermediate
+    # file instead of sending it inline do so from file_input_threshold
+    # characters on (see benchmarks/input_transport.py)
+    file_input_threshold = None
+
     input_num = None
     intermediate_file = None
 
+    # cells are submitted with an epoch; after a cell that stops on error
+    # fails, the cells queued behind it in the same epoch are dropped
+    input_epoch = None
+    input_stop = False
+    dropped_epoch = None
+
+    # shown with the next cell after a child died while idle; notices go to
+    # the kernel as "notice" messages, which are shown like the cell's
+    # output but are not part of its text
+    restart_notice = None
+
+    # cells that ran without error, replayed in a new child after the old
+    # one died (if replay_journal) or on request; input_replay is False for
+    # cells marked %%noreplay
+    replay_journal = bool(int(os.environ.get("SJK_REPLAY", 1)))
+    journal = None
+    journal_skipped = 0
+    input_code = None
+    input_replay = True
+    input_restore = False
+    restart_request = None
+
+    # the connection to the scheduler (see sjk.scheduler), when there is
+    # one; held_input is the cell that starts a new child after the
+    # scheduler terminated an idle one
+    scheduler = None
+    held_input = None
+
+    # what each cell cost the child (see sjk.usage) goes to the kernel as
+    # a "usage" message before the cell's result
+    accounting = bool(int(os.environ.get("SJK_ACCOUNTING", 1)))
+    usage_start = None
+
+    # timestamps of the running cell's stages (see sjk.timings), sent as a
+    # "timings" message before its result
+    cell_times = None
+
     @classmethod
     def syntaxchecker(cls, code):
         return ("complete", code.strip(), None)
@@ -29,6 +128,14 @@ class CasConfig(object):
     def input_cmd(cls, input_num, code, intermediate_file):
         return "{}\n{}\n".format(code, cls.prompt_cmd)
 
+    @classmethod
+    def file_input(cls, size):
+        if cls.file_input_threshold is None:
+            return False
+        threshold = os.environ.get("SJK_FILE_INPUT_THRESHOLD")
+        threshold = int(threshold) if threshold else cls.file_input_threshold
+        return size >= threshold
+
     @classmethod
     def output_filter(cls, input_num, output, intermediate_file):
         if input_num is not None and intermediate_file is not None:
@@ -36,6 +143,56 @@ class CasConfig(object):
             output = output.replace(intermediate_file.name, cell)
         return output
 
+    @classmethod
+    def stream_filter(cls, input_num, output, intermediate_file):
+        return cls.output_filter(input_num, output, intermediate_file)
+
+    # applied to every child (see sjk.limits)
+    resource_limits = limits.from_env()
+
+    # startup images (see sjk.startup): save_image_cmd saves the session
+    # once the preamble has run, image_args start a child from the image
+    save_image_cmd = None
+    image_args = None
+
+    # checkpoints (see sjk.checkpoint): checkpoint_cmd saves the session to
+    # a file and restore_cmd loads it into a running child; without
+    # restore_cmd, children are started from the file with image_args
+    # instead, from then on (restore_image)
+    checkpoint_cmd = None
+    restore_cmd = None
+    restore_image = None
+
+    # %%parmap (see CasKernel.magic_parmap) assigns its results with
+    # list_assign_cmd, formatted with the name and the comma separated items
+    list_assign_cmd = None
+
+    # fork server (see sjk.pool): fork_setup runs once in a template child,
+    # then each fork_input makes it fork a new child that reads its input
+    # from one FIFO and writes its output to another. The template prints
+    # the new child's pid, and both print the prompt
+    fork_setup = None
+    fork_cmd = None
+
+    @classmethod
+    def fork_input(cls, input_path, output_path):
+        # one line: what follows the fork on it runs in both processes
+        return "{} {}\n".format(
+            cls.fork_cmd.format(json.dumps(input_path),
+                                json.dumps(output_path)),
+            cls.prompt_cmd.strip())
+
+    # input that changes the working directory and prints the prompt, so
+    # that a pooled child can be adopted by a kernel in another directory
+    chdir_cmd = None
+
+    @classmethod
+    def chdir_input(cls, path):
+        if cls.chdir_cmd is None:
+            return None
+        return "{}\n{}\n".format(cls.chdir_cmd.format(json.dumps(path)),
+                                 cls.prompt_cmd)
+
 ###########################################################################
 
 class CasKernel(Kernel):
@@ -55,9 +212,215 @@ class CasKernel(Kernel):
 
     cas_config = CasConfig
 
+    # "process" runs the child behind a bridge process (REPL), "asyncio"
+    # drives it from the kernel's event loop (AsyncREPL)
+    driver = os.environ.get("SJK_DRIVER", "process")
+
+    # text results longer than this are paged (see sjk.outputs); None for
+    # no paging, as only a frontend that reads the comm can show the rest
+    output_page_lines = int(os.environ.get("SJK_PAGE_LINES") or 0) or None
+
+    # up to pipeline_depth execute requests queued behind the running cell
+    # are submitted to the REPL as they arrive, so that the child starts on
+    # each as soon as it is done with the previous one
+    pipeline_depth = int(os.environ.get("SJK_PIPELINE_DEPTH", 1000))
+
+    # children started for %%parmap, unless it asks for another number
+    parmap_workers = int(os.environ.get("SJK_PARMAP_WORKERS")
+                         or os.cpu_count())
+
+    # results of %%cached cells (see sjk.cache), up to result_cache_size
+    # bytes of them
+    result_cache_dir = os.environ.get("SJK_CACHE_DIR") or default_dir()
+    result_cache_size = int(float(os.environ.get("SJK_CACHE_SIZE", 256))
+                            * 2**20)
+
+    # the usage of the last usage_log_size cells is kept for %top; with
+    # usage_footer, each cell shows its own
+    usage_log_size = 10000
+    usage_footer = bool(int(os.environ.get("SJK_USAGE_FOOTER", 0)))
+
+    # the stage timings of each cell (see sjk.timings) are written to
+    # metrics_file, in the Prometheus text format, at most every
+    # metrics_interval seconds
+    metrics_file = os.environ.get("SJK_METRICS_FILE")
+    metrics_interval = 5.0
+
     def __init__(self, *args, **kwargs):
         super(CasKernel, self).__init__(*args, **kwargs)
-        self.repl = REPL(self.cas_config, start=True)
+        # output past the budget is spilled to a directory of this
+        # session's, which goes when the kernel does
+        self.spill_dir = tempfile.mkdtemp(prefix="sjk-spill-",
+                                          dir=self.cas_config.spill_dir)
+        self.cas_config.spill_dir = self.spill_dir
+        atexit.register(self.remove_spilled)
+        if self.driver == "asyncio":
+            self.repl = AsyncREPL(self.cas_config)
+        else:
+            self.repl = REPL(self.cas_config, start=True)
+        self.lookahead = collections.deque()
+        # REPL messages read ahead for later cells, by cell
+        self.held_outputs = {}
+        self.epoch = 0
+        self.output_store = OutputStore(self.output_page_lines)
+        self.workers = WorkerPool(self.cas_config)
+        self.jobs = []
+        self.result_cache = ResultCache(self.result_cache_dir,
+                                        self.result_cache_size)
+        self.usage_log = collections.deque(maxlen=self.usage_log_size)
+        self.stage_timings = StageTimings()
+        self.arrivals = {}
+        self.metrics_written = 0.0
+        self.metrics_due = False
+        if self.metrics_file:
+            self.metrics_file = self.metrics_file.format(
+                pid=os.getpid(), backend=self.cas_config.name)
+            atexit.register(self.remove_metrics)
+        self.comm_manager = CommManager(parent=self, kernel=self)
+        self.comm_manager.register_target(OutputStore.comm_target,
+                                          self.output_store.open_comm)
+        for msg_type in ('comm_open', 'comm_msg', 'comm_close'):
+            self.shell_handlers[msg_type] = getattr(self.comm_manager,
+                                                    msg_type)
+
+    # shell requests that are answered right away while a cell is running,
+    # instead of waiting behind it in the shell queue
+    concurrent_requests = (
+        'kernel_info_request',
+        'is_complete_request',
+        'complete_request',
+        'inspect_request',
+        'history_request',
+        'comm_info_request',
+        'comm_open',
+        'comm_msg',
+        'comm_close',
+    )
+
+    executing = None
+    executing_since = None
+    # whether the running cell is a magic, which may submit to the REPL
+    # later on, so that nothing can be presubmitted ahead of it
+    executing_magic = False
+    restored = None
+    # (cell, usage) of the cell being answered, for its reply's metadata
+    cell_usage = None
+    # when the request being handled arrived, and its timestamps
+    arrived = None
+    cell_times = None
+
+    @property
+    def kernel_info(self):
+        info = super(CasKernel, self).kernel_info
+        info['sjk_health'] = self.health()
+        info['sjk_cache'] = {'hits': self.result_cache.hits,
+                             'misses': self.result_cache.misses}
+        return info
+
+    def health(self):
+        # the state of the child, for monitoring: kernel_info requests are
+        # answered while a cell runs, so a wedged cell shows up here
+        health = self.repl.get_health()
+        health['cell'] = self.executing
+        health['cell_time'] = None
+        if self.executing is not None:
+            health['cell_time'] = time.monotonic() - self.executing_since
+        health['cell_timeout'] = self.cas_config.cell_timeout
+        return health
+
+    def start(self):
+        super(CasKernel, self).start()
+        if isinstance(self.repl, AsyncREPL):
+            self.io_loop.add_callback(self.repl.start)
+
+    def do_shutdown(self, restart):
+        self.remove_metrics()
+        # not to be written again by a pending write_metrics
+        self.metrics_file = None
+        self.remove_spilled()
+        return super(CasKernel, self).do_shutdown(restart)
+
+    def pre_handler_hook(self):
+        self.saved_sigint_handler = signal.signal(signal.SIGINT,
+                                                  self.handle_sigint)
+
+    def post_handler_hook(self):
+        signal.signal(signal.SIGINT, self.saved_sigint_handler)
+
+    def handle_sigint(self, signum, frame):
+        # interrupts go to the CAS child, not to the kernel; to whichever
+        # cell it runs, which may be a presubmitted one do_execute has not
+        # picked up yet
+        if self.executing is not None:
+            loop = asyncio.get_event_loop()
+            loop.call_soon_threadsafe(self.repl.interrupt, None,
+                                      time.monotonic())
+            loop.call_soon_threadsafe(self.workers.interrupt)
+
+    def schedule_dispatch(self, dispatch, *args):
+        busy = self.executing is not None or self.lookahead
+        if busy and dispatch == self.dispatch_shell:
+            idents, msg_list = self.session.feed_identities(args[0],
+                                                            copy=False)
+            header = self.session.unpack(msg_list[1].bytes)
+            if (self.executing is not None
+                    and header['msg_type'] in self.concurrent_requests):
+                asyncio.ensure_future(self.dispatch_concurrently(args[0]))
+                return
+            if header['msg_type'] == 'execute_request':
+                self.presubmit(header, msg_list)
+        if dispatch == self.dispatch_shell:
+            self.arrivals[id(args[0])] = (time.monotonic(), time.time())
+        super(CasKernel, self).schedule_dispatch(dispatch, *args)
+
+    async def dispatch_shell(self, msg, *args, **kwargs):
+        self.arrived = self.arrivals.pop(id(msg), None)
+        return await super(CasKernel, self).dispatch_shell(msg, *args,
+                                                           **kwargs)
+
+    def presubmit(self, header, msg_list):
+        # only while everything queued is presubmitted as well, so that the
+        # child still gets the cells in order
+        if (len(self.lookahead) >= self.pipeline_depth
+                or len(self.lookahead) != self.msg_queue.qsize()
+                or self.executing_magic
+                or getattr(self, '_aborting', False)):
+            return
+        # the code goes to the child before dispatch_shell checks the
+        # signature, so check it here
+        signature = self.session.sign([ part.bytes for part in msg_list[1:5] ])
+        if not hmac.compare_digest(signature, msg_list[0].bytes):
+            return
+        content = self.session.unpack(msg_list[4].bytes)
+        if (content.get('silent', False)
+                or self.find_magic(content['code']) is not None):
+            return
+        # execution_count is incremented once per non-silent request
+        num = self.execution_count + len(self.lookahead) + 1
+        self.repl.submit(num, content['code'], self.epoch,
+                         content.get('stop_on_error', True))
+        self.lookahead.append((header['msg_id'], num))
+
+    async def dispatch_concurrently(self, msg):
+        idents, msg = self.session.feed_identities(msg, copy=False)
+        msg = self.session.deserialize(msg, content=True, copy=False)
+        handler = self.shell_handlers.get(msg['header']['msg_type'])
+        if handler is None:
+            return
+        # the running cell keeps publishing under its own parent
+        ident = self._parent_ident['shell']
+        parent = self.get_parent('shell')
+        self.set_parent(idents, msg, channel='shell')
+        self._publish_status('busy', 'shell')
+        try:
+            result = handler(self.shell_stream, idents, msg)
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            self.log.error("Exception in message handler:", exc_info=True)
+        finally:
+            self._publish_status('idle', 'shell')
+            self.set_parent(ident, parent, channel='shell')
 
     def _debug_(self, msg):
         return
@@ -69,32 +432,720 @@ class CasKernel(Kernel):
         status, clean_code, err = self.cas_config.syntaxchecker(code)
         return { 'status': status }
 
-    def do_execute(self, code, silent, store_history=True, user_expressions=None,
-                   allow_stdin=False):
+    async def do_execute(self, code, silent, store_history=True,
+                         user_expressions=None, allow_stdin=False):
         ex_count = self.execution_count
+        parent = self.get_parent('shell')
+        stop_on_error = (not silent
+                         and parent['content'].get('stop_on_error', True))
         self._debug_((ex_count, code, self.repl.status.value))
-        self.repl.inqueue.put((ex_count, code))
-        self._debug_((ex_count, code, self.repl.status.value))
+        self.executing_since = time.monotonic()
+        self.cell_times = {'started': self.executing_since, 'repl': None}
+        if self.arrived is not None:
+            self.cell_times['arrived'], self.cell_times['arrived_wall'] = \
+                self.arrived
+        if hasattr(parent['header'].get('date'), 'timestamp'):
+            self.cell_times['sent'] = parent['header']['date'].timestamp()
+        try:
+            if (self.lookahead
+                    and self.lookahead[0][0] == parent['header']['msg_id']):
+                msg_id, ex_count = self.lookahead.popleft()
+                self.executing = ex_count
+                reply = await self.get_reply(ex_count)
+            else:
+                # whatever is left was aborted
+                self.lookahead.clear()
+                self.executing = ex_count
+                self.executing_magic = self.find_magic(code) is not None
+                reply = await self.run_cell(ex_count, code, stop_on_error)
+        finally:
+            self.executing = None
+            self.executing_magic = False
+        if self.cell_usage is not None and self.cell_usage[0] == ex_count:
+            self.log_usage(ex_count, code, self.cell_usage[1])
+        self.record_timings(ex_count)
+        if reply['status'] == 'error' and stop_on_error:
+            # the queue is aborted: so are the cells presubmitted from it,
+            # which the REPL drops by their epoch
+            self.epoch += 1
+            self.lookahead.clear()
+        return reply
+
+    def finish_metadata(self, parent, metadata, reply_content):
+        ex_count = reply_content.get('execution_count')
+        if self.cell_usage is not None and self.cell_usage[0] == ex_count:
+            metadata['sjk_usage'] = self.cell_usage[1]
+        self.cell_usage = None
+        return metadata
+
+    def record_timings(self, ex_count):
+        times = self.cell_times
+        times['ended'] = time.monotonic()
+        self.stage_timings.record(ex_count,
+                                  stage_durations(times, times.pop('repl')))
+        if self.metrics_file and not self.metrics_due:
+            # cells in between are written along with this one
+            self.metrics_due = True
+            asyncio.get_event_loop().call_later(
+                max(0.0, self.metrics_written + self.metrics_interval
+                    - times['ended']),
+                self.write_metrics)
+
+    def metrics_labels(self):
+        return {'backend': self.cas_config.name, 'pid': os.getpid()}
+
+    def write_metrics(self):
+        self.metrics_due = False
+        if not self.metrics_file:
+            return
+        self.metrics_written = time.monotonic()
+        try:
+            self.stage_timings.write(self.metrics_file, self.metrics_labels())
+        except OSError as e:
+            self.log.warning("sjk: metrics not written to %s: %s",
+                             self.metrics_file, e)
+
+    def remove_metrics(self):
+        if not self.metrics_file:
+            return
+        try:
+            os.unlink(self.metrics_file)
+        except OSError:
+            pass
+
+    def remove_spilled(self):
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def spilled(self, events):
+        # whether the output of a cell names a spill file of this session
+        for kind, outputs in events:
+            if isinstance(outputs, str):
+                outputs = [outputs]
+            if any(self.spill_dir in output for output in outputs):
+                return True
+        return False
+
+    def log_usage(self, ex_count, code, cell_usage):
+        lines = [ line.strip() for line in code.splitlines() if line.strip() ]
+        self.usage_log.append(dict(cell_usage, cell=ex_count,
+                                   code=lines[0] if lines else ""))
+        if self.usage_footer:
+            self.send_stream(usage.footer(cell_usage))
+
+    async def run_cell(self, ex_count, code, stop_on_error, replay=True):
+        found = self.find_magic(code)
+        if found is not None:
+            handler, magic = found
+            return await handler(ex_count, magic, stop_on_error)
+        self.repl.submit(ex_count, code, self.epoch, stop_on_error,
+                         replay=replay)
+        return await self.get_reply(ex_count)
+
+    async def next_output(self, ex_count, repl=None):
+        # the next message from repl for cell ex_count; messages of the
+        # kernel's REPL for later cells (presubmitted) are held for them,
+        # and those for earlier cells are stale
+        repl = repl or self.repl
+        if repl is self.repl:
+            for num in [ num for num in self.held_outputs if num < ex_count ]:
+                del self.held_outputs[num]
+            held = self.held_outputs.get(ex_count)
+            if held:
+                msg = held.popleft()
+                if not held:
+                    del self.held_outputs[ex_count]
+                return msg
+        while True:
+            msg = await repl.get_output()
+            num = msg[0]
+            if num == ex_count or repl is not self.repl:
+                return msg
+            if num is not None and num > ex_count:
+                self.held_outputs.setdefault(
+                    num, collections.deque()).append(msg)
+
+    async def get_reply(self, ex_count, events=None):
+        # events, if given, collects what the cell sent
+        while True:
+            num, kind, outputs = await self.next_output(ex_count)
+            if (events is not None and num == ex_count
+                    and kind not in ("usage", "timings", "notice")):
+                events.append((kind, outputs))
+            received = time.monotonic()
+            reply = self.handle_output(ex_count, num, kind, outputs)
+            if reply is not None:
+                if self.cell_times is not None:
+                    self.cell_times['received'] = received
+                    self.cell_times['published'] = time.monotonic()
+                return reply
+
+    async def capture(self, ex_count, repl=None):
+        # like get_reply, but returns whether the cell went through and its
+        # text output, instead of sending them; notices are not part of the
+        # text, and only those of the kernel's REPL are shown
+        text = []
         while True:
-            num, ok, outputs = self.repl.outqueue.get()
-            self._debug_((num, ex_count, ok, outputs))
-            if num != ex_count:
+            num, kind, outputs = await self.next_output(ex_count, repl)
+            if num != ex_count or kind in ("display", "usage", "timings"):
+                continue
+            if kind == "notice":
+                if repl is None:
+                    self.handle_output(ex_count, num, kind, outputs)
+                continue
+            if kind == "stream":
+                text.append(outputs)
                 continue
-            elif not ok:
-                self._debug_(("ERROR", outputs))
-                msg = {'status': 'error', 'execution_count': ex_count,
-                        'ename': 'cas-error', 'evalue': 'cas-error',
-                        'traceback': [outputs]}
-                self.send_response(self.iopub_socket, "error", msg)
-                return {'status': 'error', 'execution_count': ex_count,
-                        'ename': 'cas-error', 'evalue': 'cas-error',
-                        'traceback': [outputs]}
+            if kind == "ok":
+                text.append(outputs[0])
+                return True, "".join(text)
+            text.append(outputs)
+            return False, "".join(text)
+
+    def send_result(self, ex_count, text):
+        for msg_type, msg in self.process_outputs([text]):
+            self.send_response(self.iopub_socket, msg_type, msg)
+        return {'status': 'ok', 'execution_count': ex_count,
+                'payload': [], 'user_expressions': {}}
+
+    ####
+
+    def find_magic(self, code):
+        # the handler of a magic cell (see sjk.magics), or None
+        magic = magics.parse(code)
+        if magic is None:
+            return None
+        handler = getattr(self, "magic_" + magic.name, None)
+        if handler is None:
+            return None
+        return handler, magic
+
+    def fail_magic(self, ex_count, text):
+        msg = {'status': 'error', 'execution_count': ex_count,
+               'ename': 'magic-error', 'evalue': text, 'traceback': [text]}
+        self.send_response(self.iopub_socket, "error", msg)
+        return msg
+
+    def check_magic(self, ex_count, magic, cell):
+        # an error reply if magic is not used as a cell (or line) magic
+        if magic.cell and not cell:
+            return self.fail_magic(ex_count, "%{} is a line magic, not a "
+                                   "cell magic".format(magic.name))
+        if cell and not magic.cell:
+            return self.fail_magic(ex_count, "%%{} is a cell magic, not a "
+                                   "line magic".format(magic.name))
+        if not cell and magic.body.strip():
+            return self.fail_magic(ex_count, "%{} takes no cell body".format(
+                magic.name))
+        return None
+
+    async def magic_noreplay(self, ex_count, magic, stop_on_error):
+        # %%noreplay: run the cell, but leave it out of the journal
+        error = self.check_magic(ex_count, magic, cell=True)
+        if error is not None:
+            return error
+        return await self.run_cell(ex_count, magic.body, stop_on_error,
+                                   replay=False)
+
+    async def magic_cached(self, ex_count, magic, stop_on_error):
+        # %%cached: serve the cell from the result cache, or run it and
+        # cache its result; for cells that do not depend on the session
+        error = self.check_magic(ex_count, magic, cell=True)
+        if error is not None:
+            return error
+        loop = asyncio.get_event_loop()
+        cache = self.result_cache
+        key = cache.key(self.cas_config, magic.body)
+        if key is not None:
+            events = await loop.run_in_executor(None, cache.get, key)
+            if events is not None:
+                for kind, outputs in events:
+                    reply = self.handle_output(ex_count, ex_count, kind,
+                                               outputs)
+                return reply
+        # an incomplete cell is still run, for its syntax error
+        events = []
+        self.repl.submit(ex_count, magic.body, self.epoch, stop_on_error)
+        reply = await self.get_reply(ex_count, events)
+        # output past the budget is in a spill file, which goes with the
+        # session
+        if (key is not None and reply['status'] == 'ok'
+                and not self.spilled(events)):
+            try:
+                await loop.run_in_executor(None, cache.put, key, events)
+            except OSError as e:
+                self.log.warning("could not cache a result: %s", e)
+        return reply
+
+    async def magic_cache(self, ex_count, magic, stop_on_error):
+        # %cache: statistics of the result cache; %cache clear empties it
+        error = self.check_magic(ex_count, magic, cell=False)
+        if error is not None:
+            return error
+        loop = asyncio.get_event_loop()
+        cache = self.result_cache
+        if magic.args == "clear":
+            await loop.run_in_executor(None, cache.clear)
+        elif magic.args:
+            return self.fail_magic(ex_count, "usage: %cache [clear]")
+        stats = await loop.run_in_executor(None, cache.get_stats)
+        hit_rate = stats['hit_rate']
+        return self.send_result(ex_count, "\n".join([
+            "{entries} results, {size} of {max_size}, in {directory}",
+            "{hits} hits and {misses} misses this session{rate}",
+        ]).format(
+            entries=stats['entries'], directory=stats['directory'],
+            size=checkpoint.format_size(stats['size']),
+            max_size=checkpoint.format_size(stats['max_size']),
+            hits=stats['hits'], misses=stats['misses'],
+            rate=(" ({:.0%} hit rate)".format(hit_rate)
+                  if hit_rate is not None else "")))
+
+    async def magic_parmap(self, ex_count, magic, stop_on_error):
+        # %%parmap [-n N] name = template for inputs: run the cell body on
+        # N workers, then the template on each worker in turn with "{}"
+        # replaced by one of the inputs ("a..b" or a comma separated list),
+        # and assign the results to name, in order, as a list.
+        # %parmap stop: stop the workers
+        config = self.cas_config
+        if not magic.cell:
+            if magic.args != "stop" or magic.body.strip():
+                return self.fail_magic(ex_count, "usage: %parmap stop, or "
+                                       "%%parmap [-n N] name = template "
+                                       "for inputs")
+            stopped = await self.workers.stop()
+            return self.send_result(ex_count, "{} workers stopped".format(
+                stopped))
+        if config.list_assign_cmd is None:
+            return self.fail_magic(ex_count, "%%parmap is not supported for "
+                                   "{}".format(config.name))
+        match = parmap_re.fullmatch(magic.args)
+        if match is None:
+            return self.fail_magic(ex_count, "usage: %%parmap [-n N] name = "
+                                   "template for inputs")
+        size, name, template, inputs = match.groups()
+        size = int(size) if size else self.parmap_workers
+        try:
+            inputs = magics.split_items(inputs)
+        except ValueError as e:
+            return self.fail_magic(ex_count, str(e))
+        if size < 1:
+            return self.fail_magic(ex_count, "-n must be at least 1")
+        size = min(size, len(inputs))
+
+        started = time.monotonic()
+        self.send_stream("[parmap: {} inputs on {} workers]\n".format(
+            len(inputs), size))
+        # the setup runs on new workers only
+        fresh = await self.workers.start(size, magic.body)
+        if magic.body.strip():
+            for worker in fresh:
+                worker.submit(0, magic.body)
+            for ok, text in await asyncio.gather(*[
+                    self.capture(0, worker) for worker in fresh ]):
+                if not ok:
+                    await self.workers.stop()
+                    return self.fail_magic(
+                        ex_count, "the setup failed on a worker:\n" + text)
+
+        pending = collections.deque(enumerate(inputs))
+        results = [None] * len(inputs)
+        failures = []
+        progress = {'done': 0, 'shown': time.monotonic()}
+
+        async def work(worker):
+            while pending and not self.workers.interrupted:
+                index, item = pending.popleft()
+                # a worker's journal holds only the setup
+                worker.submit(index + 1, template.replace("{}", item),
+                              replay=False)
+                ok, text = await self.capture(index + 1, worker)
+                if ok and text.strip():
+                    results[index] = text.strip()
+                else:
+                    failures.append((index, text.strip() or "no result"))
+                progress['done'] += 1
+                if (time.monotonic() - progress['shown']
+                        >= config.stream_interval):
+                    self.send_stream("[parmap: {} of {} done, {} failed]\n"
+                                     .format(progress['done'], len(inputs),
+                                             len(failures)))
+                    progress['shown'] = time.monotonic()
+
+        await asyncio.gather(*[ work(worker)
+                                for worker in self.workers.workers ])
+        if pending or failures:
+            lines = [ "{} of {} inputs failed{}:".format(
+                len(failures), len(inputs),
+                ", {} not run (interrupted)".format(len(pending))
+                if pending else "") ]
+            for index, text in sorted(failures)[:20]:
+                lines.append("[{}] {}: {}".format(index + 1, inputs[index],
+                                                  text.replace("\n", " ")))
+            if len(failures) > 20:
+                lines.append("... and {} more".format(len(failures) - 20))
+            return self.fail_magic(ex_count, "\n".join(lines))
+        self.send_stream("[parmap: {} results in {:.2f} s]\n".format(
+            len(results), time.monotonic() - started))
+        self.repl.submit(ex_count, config.list_assign_cmd.format(
+            name=name, items=", ".join(results)), self.epoch, stop_on_error)
+        return await self.get_reply(ex_count)
+
+    async def magic_background(self, ex_count, magic, stop_on_error):
+        # %%background [--seed]: run the cell in a child of its own and
+        # return right away; its output replaces the job's display once it
+        # is done. With --seed, the child starts from a checkpoint of this
+        # session (see magic_checkpoint)
+        error = self.check_magic(ex_count, magic, cell=True)
+        if error is not None:
+            return error
+        config = self.cas_config
+        if magic.args not in ("", "-s", "--seed"):
+            return self.fail_magic(ex_count, "usage: %%background [--seed]")
+        if not magic.body.strip():
+            return self.fail_magic(ex_count, "%%background: nothing to run")
+        seed = None
+        if magic.args:
+            if config.checkpoint_cmd is None:
+                return self.fail_magic(ex_count, "--seed is not supported "
+                                       "for {}".format(config.name))
+            try:
+                seed = checkpoint.scratch(config)
+            except OSError as e:
+                return self.fail_magic(ex_count, str(e))
+            self.repl.submit(ex_count,
+                             config.checkpoint_cmd.format(json.dumps(seed)),
+                             self.epoch, stop_on_error, replay=False)
+            ok, text = await self.capture(ex_count)
+            if not ok or not os.path.getsize(seed):
+                os.unlink(seed)
+                return self.fail_magic(
+                    ex_count, "{} did not save the session{}".format(
+                        config.name, ": " + text if text.strip() else ""))
+        job = Job(len(self.jobs) + 1, magic.body, self.get_parent('shell'),
+                  seed)
+        self.jobs.append(job)
+        self.send_response(self.iopub_socket, 'display_data',
+                           self.job_content(job))
+        job.task = asyncio.ensure_future(self.run_job(job))
+        return {'status': 'ok', 'execution_count': ex_count,
+                'payload': [], 'user_expressions': {}}
+
+    async def run_job(self, job):
+        config = self.cas_config
+        job.worker = worker = AsyncREPL(config)
+        image = job.seed is not None and config.restore_cmd is None
+        if image:
+            worker.config.restore_image = job.seed
+        worker.start()
+        try:
+            if job.seed is not None and not image:
+                worker.submit(0, config.restore_cmd.format(
+                    json.dumps(job.seed)))
+                ok, text = await self.capture(0, worker)
+                if not ok:
+                    job.events.append(("error", "the session could not be "
+                                       "restored: " + text))
+                    job.status = "failed"
+                    return
+            job.status = "running"
+            self.update_job(job)
+            worker.submit(1, job.code)
+            while True:
+                num, kind, outputs = await worker.get_output()
+                if num != 1 or kind in ("usage", "timings"):
+                    continue
+                job.events.append((kind, outputs))
+                if kind in ("stream", "display", "notice"):
+                    self.update_job(job)
+                    continue
+                job.status = "done" if kind == "ok" else "failed"
+                break
+            if image and worker.config.restore_image is None:
+                # the REPL fell back to a fresh child
+                job.events.insert(0, ("notice", "[the saved session could "
+                                      "not be loaded: this ran without "
+                                      "it]\n"))
+        finally:
+            job.finished = time.monotonic()
+            await worker.stop()
+            if job.seed is not None:
+                os.unlink(job.seed)
+            self.update_job(job)
+
+    def job_content(self, job):
+        return {'data': self.output_data(0, job.report()), 'metadata': {},
+                'transient': {'display_id': job.display_id}}
+
+    def update_job(self, job):
+        # the job's cell is long done: send under its request all the same
+        self.session.send(self.iopub_socket, 'update_display_data',
+                          self.job_content(job), job.parent,
+                          ident=self._topic('update_display_data'))
+
+    async def magic_jobs(self, ex_count, magic, stop_on_error):
+        # %jobs: list the background jobs; %jobs N: show job N, with all
+        # its output once it is done; %jobs cancel N: stop job N
+        error = self.check_magic(ex_count, magic, cell=False)
+        if error is not None:
+            return error
+        args = magic.args.split()
+        if not args:
+            if not self.jobs:
+                return self.send_result(ex_count, "No background jobs")
+            return self.send_result(ex_count, "\n".join(
+                "{}  {}".format(job.describe(), job.code.strip()
+                                .splitlines()[0][:60])
+                for job in self.jobs))
+        cancel = args[0] == "cancel"
+        if cancel:
+            args = args[1:]
+        if len(args) != 1 or not args[0].isdigit():
+            return self.fail_magic(ex_count, "usage: %jobs [[cancel] N]")
+        if not 1 <= int(args[0]) <= len(self.jobs):
+            return self.fail_magic(ex_count, "no job {}".format(args[0]))
+        job = self.jobs[int(args[0]) - 1]
+        if cancel:
+            if job.finished is not None:
+                return self.fail_magic(ex_count, job.describe())
+            job.status = "cancelled"
+            job.task.cancel()
+            try:
+                await job.task
+            except asyncio.CancelledError:
+                pass
+            return self.send_result(ex_count, job.describe())
+        if job.finished is None or job.status == "cancelled":
+            return self.send_result(ex_count, job.report())
+        # as the cell would have shown it
+        reply = None
+        for kind, outputs in job.events:
+            reply = self.handle_output(ex_count, ex_count, kind, outputs)
+        return reply
+
+    async def magic_top(self, ex_count, magic, stop_on_error):
+        # %top [N] [cpu|wall|memory|io]: the N (default 10) cells of the
+        # session that took most of it
+        error = self.check_magic(ex_count, magic, cell=False)
+        if error is not None:
+            return error
+        keys = {
+            'cpu': lambda entry: entry['cpu'],
+            'wall': lambda entry: entry['wall'],
+            'memory': lambda entry: entry['peak_rss'] or 0,
+            'io': lambda entry: (entry.get('read_bytes', 0)
+                                 + entry.get('write_bytes', 0)),
+        }
+        count = 10
+        key = 'cpu'
+        for arg in magic.args.split():
+            if arg.isdigit():
+                count = int(arg)
+            elif arg in keys:
+                key = arg
             else:
-                #self._debug_(self.process_outputs(outputs))
-                for msg_type, msg in self.process_outputs(outputs):
-                    self.send_response(self.iopub_socket, msg_type, msg)
-                return {'status': 'ok', 'execution_count': ex_count,
-                        'payload': [], 'user_expressions': {}}
+                return self.fail_magic(ex_count, "usage: %top [N] [{}]".format(
+                    "|".join(sorted(keys))))
+        if not self.usage_log:
+            return self.send_result(ex_count, "No cells measured yet")
+        entries = sorted(self.usage_log, key=keys[key], reverse=True)[:count]
+        size = lambda value: ("-" if value is None
+                              else checkpoint.format_size(value))
+        lines = ["{:>6} {:>9} {:>9} {:>10} {:>10} {:>10}  {}".format(
+            "cell", "cpu", "wall", "peak", "read", "written", "code")]
+        for entry in entries:
+            code = entry['code']
+            if len(code) > 40:
+                code = code[:37] + "..."
+            lines.append("{:>6} {:>8.2f}s {:>8.2f}s {:>10} {:>10} {:>10}  {}"
+                         .format(entry['cell'], entry['cpu'], entry['wall'],
+                                 size(entry['peak_rss']),
+                                 size(entry.get('read_bytes')),
+                                 size(entry.get('write_bytes')), code))
+        lines.append("{} cells measured: {:.2f} s cpu, {:.2f} s wall".format(
+            len(self.usage_log),
+            sum(entry['cpu'] for entry in self.usage_log),
+            sum(entry['wall'] for entry in self.usage_log)))
+        return self.send_result(ex_count, "\n".join(lines))
+
+    async def magic_timings(self, ex_count, magic, stop_on_error):
+        # %timings [N]: where the time of the last N (default 10) cells
+        # went, stage by stage (see sjk.timings)
+        error = self.check_magic(ex_count, magic, cell=False)
+        if error is not None:
+            return error
+        args = magic.args.split()
+        if len(args) > 1 or (args and not args[0].isdigit()):
+            return self.fail_magic(ex_count, "usage: %timings [N]")
+        if not self.stage_timings.recent:
+            return self.send_result(ex_count, "No cells timed yet")
+        return self.send_result(ex_count, self.stage_timings.breakdown(
+            int(args[0]) if args else 10))
+
+    def send_stream(self, text):
+        self.send_response(self.iopub_socket, 'stream',
+                           {'name': 'stdout', 'text': text})
+
+    async def magic_journal(self, ex_count, magic, stop_on_error):
+        # %journal: list the cells a new child would be given
+        error = self.check_magic(ex_count, magic, cell=False)
+        if error is not None:
+            return error
+        self.repl.request(ex_count, "journal", self.epoch)
+        return await self.get_reply(ex_count)
+
+    async def magic_checkpoint(self, ex_count, magic, stop_on_error):
+        # %checkpoint name: save the session (see sjk.checkpoint); without
+        # a name, list the checkpoints
+        error = self.check_checkpoint(ex_count, magic)
+        if error is not None:
+            return error
+        config = self.cas_config
+        if not magic.args:
+            return self.send_result(ex_count, self.list_checkpoints())
+        loop = asyncio.get_event_loop()
+        started = time.monotonic()
+        try:
+            checkpoint.paths(config, magic.args)
+            raw = checkpoint.scratch(config)
+        except (OSError, ValueError) as e:
+            return self.fail_magic(ex_count, str(e))
+        self.repl.submit(ex_count,
+                         config.checkpoint_cmd.format(json.dumps(raw)),
+                         self.epoch, stop_on_error, replay=False)
+        ok, text = await self.capture(ex_count)
+        if not ok or not os.path.getsize(raw):
+            os.unlink(raw)
+            return self.fail_magic(
+                ex_count, "{} did not save the session{}".format(
+                    config.name, ": " + text if text.strip() else ""))
+        try:
+            info = await loop.run_in_executor(
+                None, checkpoint.save, config, magic.args, raw,
+                time.monotonic() - started)
+        except OSError as e:
+            return self.fail_magic(ex_count, "could not save the checkpoint: "
+                                   "{}".format(e))
+        return self.send_result(ex_count, "Checkpoint " +
+                                checkpoint.describe(magic.args, info))
+
+    async def magic_restore(self, ex_count, magic, stop_on_error):
+        # %restore name: bring back a session saved by %checkpoint
+        error = self.check_checkpoint(ex_count, magic)
+        if error is not None:
+            return error
+        config = self.cas_config
+        if not magic.args:
+            return self.send_result(ex_count, self.list_checkpoints())
+        loop = asyncio.get_event_loop()
+        started = time.monotonic()
+        try:
+            raw, info = await loop.run_in_executor(
+                None, checkpoint.load, config, magic.args)
+        except (OSError, ValueError) as e:
+            return self.fail_magic(ex_count, str(e))
+        if config.restore_cmd is None:
+            # the child is started from it, which only works with the
+            # binary that saved it
+            if info['binary'] != startup.binary_key(config):
+                os.unlink(raw)
+                return self.fail_magic(ex_count, "checkpoint {!r} was saved "
+                                       "by another {} installation".format(
+                                           magic.args, config.name))
+            self.repl.request(ex_count, "restart", self.epoch, image=raw)
+        else:
+            self.repl.submit(ex_count,
+                             config.restore_cmd.format(json.dumps(raw)),
+                             self.epoch, stop_on_error, restore=True)
+        ok, text = await self.capture(ex_count)
+        if not ok:
+            os.unlink(raw)
+            return self.fail_magic(ex_count, "checkpoint {!r} could not be "
+                                   "restored: {}".format(magic.args, text))
+        # the file is kept for the journal, or to start children from
+        if self.restored is None:
+            atexit.register(self.remove_restored)
+        self.remove_restored()
+        self.restored = raw
+        return self.send_result(ex_count, "Checkpoint {} ({}) restored in "
+                                "{:.2f} s; it was saved {}".format(
+                                    magic.args,
+                                    checkpoint.format_size(info['size']),
+                                    time.monotonic() - started,
+                                    time.strftime(
+                                        "%Y-%m-%d %H:%M",
+                                        time.localtime(info['saved']))))
+
+    def remove_restored(self):
+        if self.restored is not None and os.path.exists(self.restored):
+            os.unlink(self.restored)
+
+    def check_checkpoint(self, ex_count, magic):
+        error = self.check_magic(ex_count, magic, cell=False)
+        if error is None and self.cas_config.checkpoint_cmd is None:
+            error = self.fail_magic(ex_count, "checkpoints are not supported "
+                                    "for {}".format(self.cas_config.name))
+        return error
+
+    def list_checkpoints(self):
+        config = self.cas_config
+        checkpoints = checkpoint.list_checkpoints(config)
+        if not checkpoints:
+            return "No checkpoints in {}".format(
+                checkpoint.checkpoint_dir(config))
+        return "\n".join(checkpoint.describe(name, info)
+                         for name, info in checkpoints)
+
+    async def magic_replay(self, ex_count, magic, stop_on_error):
+        # %replay: start a new child and replay the journal in it
+        error = self.check_magic(ex_count, magic, cell=False)
+        if error is not None:
+            return error
+        self.repl.request(ex_count, "restart", self.epoch)
+        return await self.get_reply(ex_count)
+
+    def handle_output(self, ex_count, num, kind, outputs):
+        self._debug_((num, ex_count, kind, outputs))
+        if num != ex_count:
+            return None
+        elif kind in ("stream", "notice"):
+            stream_content = {'name': 'stdout', 'text': outputs}
+            self.send_response(self.iopub_socket, 'stream', stream_content)
+        elif kind == "display":
+            mess = dict(data=self.output_data(1, outputs), metadata={})
+            self.send_response(self.iopub_socket, 'display_data', mess)
+        elif kind == "usage":
+            self.cell_usage = (ex_count, outputs)
+        elif kind == "timings":
+            if self.cell_times is not None:
+                self.cell_times['repl'] = outputs
+        elif kind == "interrupted":
+            msg = {'status': 'error', 'execution_count': ex_count,
+                    'ename': 'interrupted', 'evalue': outputs,
+                    'traceback': [outputs]}
+            self.send_response(self.iopub_socket, "error", msg)
+            return msg
+        elif kind == "exited":
+            msg = {'status': 'error', 'execution_count': ex_count,
+                    'ename': 'cas-exited', 'evalue': outputs,
+                    'traceback': [outputs]}
+            self.send_response(self.iopub_socket, "error", msg)
+            return msg
+        elif kind == "error":
+            self._debug_(("ERROR", outputs))
+            msg = {'status': 'error', 'execution_count': ex_count,
+                    'ename': 'cas-error', 'evalue': 'cas-error',
+                    'traceback': [outputs]}
+            self.send_response(self.iopub_socket, "error", msg)
+            return {'status': 'error', 'execution_count': ex_count,
+                    'ename': 'cas-error', 'evalue': 'cas-error',
+                    'traceback': [outputs]}
+        else:
+            #self._debug_(self.process_outputs(outputs))
+            for msg_type, msg in self.process_outputs(outputs):
+                self.send_response(self.iopub_socket, msg_type, msg)
+            return {'status': 'ok', 'execution_count': ex_count,
+                    'payload': [], 'user_expressions': {}}
+        return None
 
     def process_outputs(self, outputs):
         proc_outs = []
@@ -102,16 +1153,9 @@ class CasKernel(Kernel):
         for n, output in enumerate(outputs):
             if output == "":
                 continue
-            if n == 0:
-                if output[-1] == "\n":
-                    output = output[:-1]
-                data = {'text/plain': str(output)}
-            else:
-                try:
-                    data = json.loads(output)
-                except:
-                    data = {'text/plain': str(output)}
-            mess = dict(data=data, metadata={})
+            if n == 0 and output[-1] == "\n":
+                output = output[:-1]
+            mess = dict(data=self.output_data(n, output), metadata={})
             if n == last:
                 mess['execution_count'] = self.execution_count
                 proc_outs.append(('execute_result', mess))
@@ -119,6 +1163,15 @@ class CasKernel(Kernel):
                 proc_outs.append(('display_data', mess))
         return proc_outs
 
+    def output_data(self, n, output):
+        if n == 0:
+            return (self.output_store.page(str(output))
+                    or {'text/plain': str(output)})
+        try:
+            return json.loads(output)
+        except:
+            return {'text/plain': str(output)}
+
 
 ###########################################################################
 
@@ -126,6 +1179,7 @@ class REPL(object):
 
     def __init__(self, config, start=False):
         self.config = config
+        self.results = None
         if start:
             self.start()
 
@@ -134,87 +1188,1635 @@ class REPL(object):
         self.inqueue = multiprocessing.Queue()
         self.outqueue = multiprocessing.Queue()
         self.status = multiprocessing.Array('c', 100)
+        self.health = multiprocessing.Array('c', 1000)
+        control, self.control = multiprocessing.Pipe(duplex=False)
         self.proc = multiprocessing.Process(
             target = REPL.repl,
             args = (self.config,
                     self.inqueue,
                     self.outqueue,
-                    self.status))
+                    self.status,
+                    self.health,
+                    control))
         self.proc.daemon = True
         self.proc.start()
 
+    def submit(self, num, code, epoch=0, stop_on_error=False, **options):
+        options['submitted'] = time.monotonic()
+        self.inqueue.put((num, code, epoch, stop_on_error, options))
+
+    def request(self, num, request, epoch=0, **options):
+        # see REPL.handle_request
+        options['request'] = request
+        self.inqueue.put((num, None, epoch, False, options))
+
+    def interrupt(self, num, sent=None):
+        # see REPL.interrupts
+        if sent is None:
+            sent = time.monotonic()
+        self.control.send(("interrupt", num, sent))
+
+    def get_health(self):
+        return REPL.report_health(self.status, self.health)
+
+    async def get_output(self):
+        # outqueue is drained by a thread, so that waiting on it does not
+        # block the event loop and an abandoned wait does not lose messages
+        if self.results is None:
+            self.results = asyncio.Queue()
+            forward = threading.Thread(
+                target = self.forward_outputs,
+                args = (asyncio.get_event_loop(), self.results))
+            forward.daemon = True
+            forward.start()
+        return await self.results.get()
+
+    def forward_outputs(self, loop, results):
+        while True:
+            msg = self.outqueue.get()
+            loop.call_soon_threadsafe(results.put_nowait, msg)
+
     @staticmethod
-    def repl(config, inqueue, outqueue, status):
-        # start and initialize child
-        status.value = b"initializing"
+    def repl(config, inqueue, outqueue, status, health, control):
+        # interrupts are forwarded by the kernel through control; unlike
+        # SIG_IGN, a handler is not inherited by the child
+        signal.signal(signal.SIGINT, lambda signum, frame: None)
+
+        restarts = 0
+        # set once a child is gone: see after_exit
+        restart = None
+        while True:
+            status.value = b"initializing"
+            child, reader = REPL.start_child(config)
+            if child is None:
+                status.value = b"exited"
+                REPL.set_health(health, pid=None)
+                if restart is not None:
+                    REPL.report_restart(config, outqueue, restart,
+                                        "starting it again failed",
+                                        failed=True)
+                    restart = None
+                if config.restore_image is not None:
+                    # start one without the checkpoint instead
+                    config.restore_image = None
+                    continue
+                # try again with the next cell, answering this one
+                REPL.refuse_input(
+                    config, inqueue, outqueue,
+                    "{} could not be started".format(config.name))
+                restarts += 1
+                continue
+            atexit.register(child.kill)
+            writer = InputWriter(child.stdin.fileno())
+            REPL.set_health(health, pid=child.pid, restarts=restarts, cells=0)
+            config.input_num = None
+
+            replayed = 0
+            if restart is not None:
+                outcome = "it was restarted, and all its state is lost"
+                if restart[3] and config.journal:
+                    status.value = b"replaying"
+                    if config.scheduler is not None:
+                        # a replay is work like a cell's
+                        config.scheduler.acquire(lambda msg: None)
+                    started = time.monotonic()
+                    replayed = REPL.replay(config, child, writer, reader,
+                                           outqueue, control, restart[0])
+                    if REPL.replay_stopped(config, reader, replayed):
+                        outcome = REPL.replay_interrupted(config, reader,
+                                                          replayed)
+                    elif replayed < len(config.journal):
+                        # the journal kills it: start afresh
+                        writer.close()
+                        child.kill()
+                        child.wait()
+                        restart = REPL.replay_failed(config, restart,
+                                                     replayed, reader)
+                        restarts += 1
+                        continue
+                    else:
+                        outcome = REPL.replay_note(
+                            config, replayed, time.monotonic() - started)
+                    REPL.set_health(health, replayed=replayed)
+                REPL.report_restart(config, outqueue, restart, outcome)
+                restart = None
+
+            cells = 0
+
+            # main loop
+            while REPL.read_output(config, child, writer, reader,
+                                   outqueue, control):
+                status.value = b"awaiting input"
+                if not REPL.feed_child(config, child, writer,
+                                       inqueue, outqueue, control):
+                    break
+                status.value = b"reading output"
+                cells += 1
+                REPL.set_health(health, cells=cells)
+
+            # the child exited, the watchdog killed it, or a restart was
+            # asked for
+            status.value = b"restarting"
+            writer.close()
+            child.kill()
+            exit_status = limits.explain(config.resource_limits, child.pid,
+                                         REPL.describe_exit(child.wait()))
+            reaped = REPL.reaped(config)
+            if reaped is not None:
+                # not one that dies as it starts
+                exit_status = reaped
+                cells = max(cells, 1)
+            restarts += 1
+            REPL.set_health(health, pid=None, restarts=restarts,
+                            last_exit=exit_status)
+            msgs, restart, refusal = REPL.after_exit(
+                config, reader, exit_status, cells, replayed)
+            for msg in msgs:
+                outqueue.put(msg)
+            if refusal is not None:
+                status.value = b"exited"
+                REPL.refuse_input(config, inqueue, outqueue, refusal)
+            elif reaped is not None:
+                # the next child starts with the next cell
+                status.value = b"terminated while idle"
+                config.held_input = inqueue.get()
+
+    @staticmethod
+    def start_child(config):
+        # start and initialize a child, or adopt a ready one from the pool
+        child = None
+        if (os.environ.get("SJK_POOL_SOCKET")
+                and config.restore_image is None):
+            from . import pool
+            child = pool.adopt(config, os.environ["SJK_POOL_SOCKET"])
+        if child is not None:
+            REPL.apply_limits(config, child.pid)
+            reader = OutputReader(config, child.stdout.fileno())
+            reader.pending = child.pending
+        else:
+            cmd, setup = startup.prepare(config)
+            child, reader = REPL.boot(config, cmd, setup)
+            if child is None:
+                return None, None
+            # the main loop starts by reading the prompt boot already read
+            reader.pending = config.prompt_char + reader.pending
+        REPL.register_child(config, child.pid)
+        return child, reader
+
+    @staticmethod
+    def register_child(config, pid, blocking=True):
+        # tells the scheduler, if there is one, about a new child
+        path = os.environ.get("SJK_SCHEDULER_SOCKET")
+        if not path:
+            return
+        if config.scheduler is None:
+            from . import scheduler
+            config.scheduler = scheduler.SchedulerClient.connect(
+                path, blocking=blocking)
+            if config.scheduler is None:
+                return
+        config.scheduler.register(config.name, pid)
+
+    @staticmethod
+    def reaped(config):
+        # once a child is gone: why, if the scheduler terminated it
+        if config.scheduler is None:
+            return None
+        config.scheduler.release()
+        return config.scheduler.poll()
 
-        child = subprocess.Popen(config.cmd,
+    @staticmethod
+    def spawn(config, cmd=None):
+        child = subprocess.Popen(cmd or config.cmd,
                                  stdin=subprocess.PIPE,
                                  stdout=subprocess.PIPE,
                                  stderr=subprocess.STDOUT,
                                  encoding="utf8",
-                                 errors="replace")
-        atexit.register(child.kill)
+                                 errors="replace",
+                                 start_new_session=True,
+                                 env=limits.child_env(config.resource_limits))
+        REPL.apply_limits(config, child.pid)
+        return child
+
+    @staticmethod
+    def apply_limits(config, pid):
+        err = limits.apply(config.resource_limits, pid)
+        if err is not None:
+            sys.stderr.write("sjk: {}\n".format(err))
 
+    @staticmethod
+    def boot(config, cmd=None, setup=None, timeout=None):
+        # start a child and read up to its first prompt, running the setup
+        # code (a startup preamble) before it if given
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            child = REPL.spawn(config, cmd)
+        except OSError:
+            return None, None
         if config.initial_input is not None:
             child.stdin.write(config.initial_input)
             child.stdin.flush()
+        reader = OutputReader(config, child.stdout.fileno())
+        ok = REPL.skip_output(reader, deadline)
+        if ok and setup is not None:
+            text, err = REPL.prepare_input(config, setup)
+            if text is None:
+                sys.stderr.write("sjk: preamble not run: {}\n".format(err))
+            else:
+                child.stdin.write(text)
+                child.stdin.flush()
+                ok = REPL.skip_output(reader, deadline)
+        if not ok:
+            child.kill()
+            child.wait()
+            return None, None
+        return child, reader
 
-        # main loop
-        while True:
-            if not REPL.read_output(config, child, outqueue):
-                status.value = b"exited"
-                break
-            status.value = b"awaiting input"
-            REPL.feed_child(config, child, inqueue, outqueue)
-            status.value = b"reading output"
+    @staticmethod
+    def skip_output(reader, deadline=None):
+        reader.start()
+        while not reader.done:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.monotonic())
+            ready, _, _ = select.select([reader.fd], [], [], timeout)
+            data = os.read(reader.fd, reader.chunk_size) if ready else b""
+            if not data:
+                return False
+            reader.feed(data)
+        return True
 
     @staticmethod
-    def read_output(config, child, outqueue):
-        output = [""]
-        idx = 0
-        while True:
-            c = child.stdout.read(1)
-            if not c:
+    def read_output(config, child, writer, reader, outqueue, control):
+        # False once the child has exited, or was killed by the watchdog
+        fd = reader.fd
+        reader.start()
+        while not reader.done:
+            timeout = None
+            if config.input_num != None:
+                timeout = reader.stream_timeout()
+                if timeout == 0:
+                    for msg in REPL.stream_output(config, reader):
+                        outqueue.put(msg)
+                    continue
+                due = reader.watchdog_timeout()
+                if due == 0:
+                    if reader.interrupted is not None:
+                        reader.killed = True
+                        return False
+                    reader.timed_out = True
+                    REPL.interrupt_child(config, child, writer, reader,
+                                         time.monotonic())
+                    continue
+                if due is not None and (timeout is None or due < timeout):
+                    timeout = due
+            ready, _, _ = select.select([fd, control], [], [], timeout)
+            if control in ready:
+                action, num, since = control.recv()
+                if action == "interrupt" and REPL.interrupts(config, num,
+                                                             since):
+                    REPL.interrupt_child(config, child, writer, reader, since)
+            if fd in ready:
+                data = os.read(fd, reader.chunk_size)
+                if not data:
+                    return False
+                reader.feed(data)
+        if reader.interrupted is not None and not REPL.settle(config, reader):
+            return False
+        for msg in REPL.finish_output(config, reader):
+            outqueue.put(msg)
+        return True
+
+    @staticmethod
+    def settle(config, reader):
+        # after an interrupt, drains output until it has been quiet for
+        # interrupt_settle; False if the child exited or was killed
+        fd = reader.fd
+        while select.select([fd], [], [], config.interrupt_settle)[0]:
+            if reader.watchdog_timeout() == 0:
+                reader.killed = True
                 return False
-            output[idx] += c
-            if output[idx][-1] == config.prompt_char:
-                output[idx] = output[idx][:-1]
-                break
-            elif output[idx][-1] == config.output_separator:
-                output[idx] = output[idx][:-1]
-                output.append("")
-                idx += 1
-        if len(output[0])>0 and output[0][0]=="\n":
+            if not os.read(fd, reader.chunk_size):
+                return False
+        reader.discard()
+        return True
+
+    @staticmethod
+    def interrupt_child(config, child, writer, reader, since):
+        if reader.interrupted is not None:
+            return
+        reader.interrupted = since
+        try:
+            os.kill(child.pid, config.interrupt_signal)
+        except ProcessLookupError:
+            # read_output sees it exit
+            return
+        # the rest of a cell still being written would only run afterwards
+        writer.cancel()
+        writer.write(config.interrupt_input)
+
+    @staticmethod
+    def stream_output(config, reader):
+        msgs = []
+        first = not reader.streamed
+        text, displays = reader.take_partial(config.stream_holdback)
+        if first and text[:1] == "\n":
+            text = text[1:]
+        if text:
+            text = config.stream_filter(config.input_num,
+                                        text,
+                                        config.intermediate_file)
+            msgs.append((config.input_num, "stream", text))
+        for output in displays:
+            msgs.append((config.input_num, "display", output))
+        return msgs
+
+    @staticmethod
+    def finish_output(config, reader):
+        prompt = time.monotonic()
+        msgs = []
+        output = reader.outputs()
+        if not reader.streamed and len(output[0])>0 and output[0][0]=="\n":
             output[0] = output[0][1:]
         if config.input_num != None:
             output[0] = config.output_filter(config.input_num,
                                              output[0],
                                              config.intermediate_file)
-            outqueue.put((config.input_num, True, output))
-        if config.use_intermediate_file:
+            if config.usage_start is not None:
+                cell_usage = usage.finish(config.usage_start)
+                config.usage_start = None
+                if cell_usage is not None:
+                    msgs.append((config.input_num, "usage", cell_usage))
+            if reader.interrupted is None:
+                msgs.append((config.input_num, "ok", output))
+                REPL.record(config)
+            else:
+                # whatever was printed before the interrupt is still shown
+                if output[0]:
+                    msgs.append((config.input_num, "stream", output[0]))
+                reason = "Interrupted"
+                if reader.timed_out:
+                    reason = "Timed out after {:g} s and interrupted".format(
+                        config.cell_timeout)
+                msgs.append((config.input_num, "interrupted",
+                             "{}; ready again after {:.2f} s".format(
+                                 reason,
+                                 time.monotonic() - reader.interrupted)))
+                if config.input_stop:
+                    config.dropped_epoch = config.input_epoch
+            if config.cell_times is not None:
+                # just before the result
+                config.cell_times.update(prompt=prompt,
+                                         scan=reader.scan_time,
+                                         finished=time.monotonic())
+                msgs.insert(len(msgs) - 1, (config.input_num, "timings",
+                                            config.cell_times))
+                config.cell_times = None
+        return msgs
+
+    @staticmethod
+    def after_exit(config, reader, exit_status, cells, replayed):
+        # Once a child is gone: the messages to send right away; the
+        # restart to report once a new child is up, as (cell or None for
+        # the next one, kind of message, what happened, whether to replay
+        # the journal); and, if it died before running any new cell, a
+        # note to refuse the next cell with instead of starting (and
+        # replaying) one over and over.
+        if config.restart_request is not None:
+            restart = (config.restart_request, "ok",
+                       "{} was stopped".format(config.name), True)
+            config.restart_request = None
+            return [], restart, None
+        msgs = []
+        num = config.input_num
+        if num is not None:
+            # the cell fails with what it printed so far
+            output = reader.outputs()[0]
+            if output.strip():
+                output = config.output_filter(num, output.lstrip("\n"),
+                                              config.intermediate_file)
+                msgs.append((num, "stream", output))
+            if config.input_stop:
+                config.dropped_epoch = config.input_epoch
+            config.input_num = None
+        if reader.killed:
+            if reader.timed_out:
+                what = "timed out after {:g} s".format(config.cell_timeout)
+            else:
+                what = "was interrupted"
+            what = ("The cell {} and {} did not respond within {:g} s, so "
+                    "it was killed".format(what, config.name,
+                                           config.kill_timeout))
+        else:
+            what = "{} {}".format(config.name, exit_status)
+        if not cells and replayed:
+            # the journal is what kills it
+            config.journal = []
+            config.journal_skipped = 0
+            return msgs, None, ("{} right after its journal was replayed, "
+                                "so the journal is dropped".format(what))
+        if not cells:
+            return msgs, None, "{} right after it started".format(what)
+        return msgs, (num, "exited", what, config.replay_journal), None
+
+    @staticmethod
+    def report_restart(config, outqueue, restart, outcome, failed=False):
+        # tells the cell in restart, or the next one, how it went
+        num, kind, what, replay = restart
+        text = "{}; {}".format(what, outcome)
+        if failed:
+            kind = "exited"
+        if num is None:
+            config.restart_notice = "[{}]\n".format(text)
+        elif kind == "ok":
+            outqueue.put_nowait((num, kind, [text]))
+        else:
+            outqueue.put_nowait((num, kind, text))
+
+    @staticmethod
+    def replay_note(config, cells, seconds):
+        note = ("it was restarted, and its state restored by replaying {} "
+                "cells in {:.2f} s".format(cells, seconds))
+        if config.journal_skipped:
+            note += ", skipping {} marked %%noreplay".format(
+                config.journal_skipped)
+        return note
+
+    @staticmethod
+    def replay_failed(config, restart, cells, reader):
+        num, kind, what, replay = restart
+        if reader.killed:
+            # a journaled cell that hangs: the next child gets the ones
+            # before it
+            what = ("{}; replaying its journal {} at cell {} of {}, and {} "
+                    "did not respond, so it was killed".format(
+                        what, REPL.replay_stop(reader), cells + 1,
+                        len(config.journal), config.name))
+            config.journal = config.journal[:cells]
+            return (num, kind, what, True)
+        what = "{}; replaying its journal stopped it at cell {} of {}".format(
+            what, cells + 1, len(config.journal))
+        config.journal = []
+        config.journal_skipped = 0
+        return (num, kind, what, False)
+
+    @staticmethod
+    def replay_stopped(config, reader, cells):
+        # whether the replay was interrupted (or timed out) with the child
+        # back at its prompt
+        return (cells < len(config.journal) and reader.interrupted is not None
+                and not reader.killed)
+
+    @staticmethod
+    def replay_stop(reader):
+        return "timed out" if reader.timed_out else "was interrupted"
+
+    @staticmethod
+    def replay_interrupted(config, reader, cells):
+        # the journal is cut where the replay stopped, so that it matches
+        # the child's state
+        note = ("it was restarted, but the replay of its journal {} at cell "
+                "{} of {}, so only the state from the cells before it was "
+                "restored".format(REPL.replay_stop(reader), cells + 1,
+                                  len(config.journal)))
+        config.journal = config.journal[:cells]
+        return note
+
+    @staticmethod
+    def replay(config, child, writer, reader, outqueue, control, num):
+        # runs the journal in a new child, discarding its output, with
+        # progress shown in cell num if given; returns how many cells ran.
+        # A cell that is interrupted, or times out, stops the replay
+        if not REPL.skip_output(reader):
+            return 0
+        total = len(config.journal)
+        started = shown = time.monotonic()
+        for n, (cell, code) in enumerate(config.journal):
+            text, err = REPL.prepare_input(config, code)
+            if text is None:
+                continue
+            writer.write(text)
+            if not REPL.replay_output(config, child, writer, reader,
+                                      control, started):
+                return n
+            reader.clear()
+            if reader.interrupted is not None:
+                reader.pending = config.prompt_char
+                return n
+            if num is not None and (time.monotonic() - shown
+                                    >= config.stream_interval):
+                outqueue.put((num, "notice", "[replaying: {} of {} cells]\n"
+                              .format(n + 1, total)))
+                shown = time.monotonic()
+        # the main loop starts by reading a prompt
+        reader.pending = config.prompt_char + reader.pending
+        return total
+
+    @staticmethod
+    def replay_output(config, child, writer, reader, control, since):
+        # skip_output for a replayed cell, but with the watchdog, and the
+        # interrupts sent since the replay started, as in read_output
+        fd = reader.fd
+        reader.start()
+        while not reader.done:
+            due = reader.watchdog_timeout()
+            if due == 0:
+                if reader.interrupted is not None:
+                    reader.killed = True
+                    return False
+                reader.timed_out = True
+                REPL.interrupt_child(config, child, writer, reader,
+                                     time.monotonic())
+                continue
+            ready, _, _ = select.select([fd, control], [], [], due)
+            if control in ready:
+                action, num, sent = control.recv()
+                if action == "interrupt" and sent >= since:
+                    REPL.interrupt_child(config, child, writer, reader, sent)
+            if fd in ready:
+                data = os.read(fd, reader.chunk_size)
+                if not data:
+                    return False
+                reader.feed(data)
+        if reader.interrupted is not None:
+            return REPL.settle(config, reader)
+        return True
+
+    @staticmethod
+    def record(config):
+        # the journal holds the cells that ran without error, to be replayed
+        # in a new child
+        if config.journal is None or config.input_restore:
+            # a restored checkpoint replaces what came before
+            config.journal = []
+            config.journal_skipped = 0
+        if config.input_replay:
+            config.journal.append((config.input_num, config.input_code))
+        else:
+            config.journal_skipped += 1
+
+    @staticmethod
+    def describe_exit(returncode):
+        if returncode is None:
+            return "exited"
+        if returncode < 0:
             try:
-                config.intermediate_file.close()
-            except:
+                return "was killed by {}".format(
+                    signal.Signals(-returncode).name)
+            except ValueError:
+                return "was killed by signal {}".format(-returncode)
+        return "exited with status {}".format(returncode)
+
+    @staticmethod
+    def set_health(health, **fields):
+        # health holds what REPL knows about its child as JSON, written by
+        # the REPL only
+        info = json.loads(health.value.decode("utf8") or "{}")
+        info.update(fields)
+        health.value = json.dumps(info).encode("utf8")
+
+    @staticmethod
+    def report_health(status, health):
+        info = {'pid': None, 'restarts': 0, 'cells': 0, 'last_exit': None}
+        info.update(json.loads(health.value.decode("utf8") or "{}"))
+        info['status'] = status.value.decode("utf8")
+        info['alive'] = False
+        if info['pid'] is not None:
+            try:
+                os.kill(info['pid'], 0)
+                info['alive'] = True
+            except OSError:
                 pass
+        return info
+
+    @staticmethod
+    def feed_child(config, child, writer, inqueue, outqueue, control):
+        # False if the child died while waiting for input
+        if config.scheduler is not None:
+            config.scheduler.release()
+        while True:
+            if config.held_input is not None:
+                item, config.held_input = config.held_input, None
+            else:
+                try:
+                    item = inqueue.get(timeout=config.watch_interval)
+                except queue.Empty:
+                    if child.poll() is not None:
+                        # no cell is running
+                        config.input_num = None
+                        return False
+                    continue
+            handled, msg = REPL.handle_request(config, item)
+            if handled:
+                if msg is None:
+                    return False
+                outqueue.put(msg)
+                continue
+            text, err = REPL.next_input(config, item)
+            if text is not None and REPL.admit(config, outqueue, control):
+                break
+            if err is not None:
+                outqueue.put((config.input_num, "error", err))
+        if config.restart_notice is not None:
+            outqueue.put((config.input_num, "notice", config.restart_notice))
+            config.restart_notice = None
+        REPL.start_cell(config, child.pid)
+        writer.write(text)
         return True
 
     @staticmethod
-    def feed_child(config, child, inqueue, outqueue):
+    def start_cell(config, pid):
+        config.usage_start = usage.start(pid) if config.accounting else None
+        config.cell_times['written'] = time.monotonic()
+
+    @staticmethod
+    def admit(config, outqueue, control):
+        # waits for the scheduler to grant the cell a slot; False if it was
+        # interrupted while queued
+        if config.scheduler is None:
+            return True
+        num = config.input_num
+        def interrupted():
+            action, cell, since = control.recv()
+            return action == "interrupt" and REPL.interrupts(config, cell,
+                                                             since)
+        waited = config.scheduler.acquire(
+            lambda msg: outqueue.put((num, "notice", REPL.queued_notice(msg))),
+            control, interrupted)
+        for msg in REPL.admission(config, waited):
+            outqueue.put(msg)
+        return waited is not None
+
+    @staticmethod
+    def interrupts(config, num, sent):
+        # whether an interrupt for cell num, sent at sent, is for the cell
+        # taken last; one for no cell in particular (None) is, unless it
+        # was sent before that cell was taken, for a cell that is done
+        if num is None:
+            return (config.input_num is not None
+                    and config.cell_times is not None
+                    and sent >= config.cell_times['dequeued'])
+        return num == config.input_num
+
+    @staticmethod
+    def queued_notice(msg):
+        return ("[queued: {} of {} cells allowed are running on this host, "
+                "{} waiting ahead of this one]\n".format(
+                    msg['running'], msg['limit'], msg['position'] - 1))
+
+    @staticmethod
+    def admission(config, waited):
+        # messages once the cell was granted its slot after waiting
+        # seconds, or interrupted while queued (None)
+        num = config.input_num
+        if waited is None:
+            if config.input_stop:
+                config.dropped_epoch = config.input_epoch
+            config.input_num = None
+            return [(num, "interrupted", "Interrupted while queued")]
+        if config.scheduler.queued:
+            return [(num, "notice",
+                     "[started after waiting {:.1f} s]\n".format(waited))]
+        return []
+
+    @staticmethod
+    def handle_request(config, item):
+        # Items without code are requests: "restart" for a new child with
+        # the journal replayed, "journal" to list it. Returns whether item
+        # was a request, and the message answering it (None for a restart,
+        # which ends the main loop and is answered by the new child).
+        num, raw_code, epoch, stop_on_error, options = item
+        if raw_code is not None:
+            return False, None
+        if options['request'] == "restart":
+            # with an image, a checkpoint to start from (and no journal)
+            config.input_num = None
+            image = options.get('image')
+            if image is not None:
+                config.restore_image = image
+                config.journal = []
+                config.journal_skipped = 0
+            config.restart_request = num
+            return True, None
+        journal = config.journal or []
+        lines = ["{} cells in the journal, {} marked %%noreplay; {}".format(
+            len(journal), config.journal_skipped,
+            "replayed automatically in a new child" if config.replay_journal
+            else "replayed with %replay")]
+        for cell, code in journal:
+            first = code.strip().split("\n")[0]
+            if len(first) > 72:
+                first = first[:69] + "..."
+            lines.append("[{}] {}".format(cell, first))
+        return True, (num, "ok", ["\n".join(lines)])
+
+    @staticmethod
+    def refuse_input(config, inqueue, outqueue, note):
+        # answers the next cell with note instead of running it
+        msg = None
+        while msg is None:
+            msg = REPL.refusal(config, inqueue.get(), note)
+        outqueue.put(msg)
+
+    @staticmethod
+    def refusal(config, item, note):
+        num, raw_code, epoch, stop_on_error, options = item
+        if epoch == config.dropped_epoch:
+            return None
+        if stop_on_error:
+            config.dropped_epoch = epoch
+        config.restart_notice = None
+        return (num, "exited",
+                "{}; trying again for the next cell".format(note))
+
+    @staticmethod
+    def next_input(config, item):
+        num, raw_code, epoch, stop_on_error, options = item
+        if epoch == config.dropped_epoch:
+            return None, None
+        config.input_num = num
+        config.input_epoch = epoch
+        config.input_stop = stop_on_error
+        config.input_code = raw_code
+        config.input_replay = options.get('replay', True)
+        config.input_restore = options.get('restore', False)
+        config.cell_times = times = {'submitted': options.get('submitted'),
+                                     'dequeued': time.monotonic()}
+        text, err = REPL.prepare_input(config, raw_code, times)
+        times['prepared'] = time.monotonic()
+        if text is None and stop_on_error:
+            config.dropped_epoch = epoch
+        return text, err
+
+    @staticmethod
+    def prepare_input(config, raw_code, times=None):
+        status, code, err = config.syntaxchecker(raw_code)
+        if times is not None:
+            times['checked'] = time.monotonic()
+        if status != "complete":
+            return None, err
+        if (config.use_intermediate_file
+                or config.file_input_threshold is not None):
+            if config.intermediate_file is None:
+                config.intermediate_file = IntermediateFile()
+        if config.use_intermediate_file:
+            config.intermediate_file.write(code)
+        return config.input_cmd(
+            config.input_num, code, config.intermediate_file), None
+
+
+###########################################################################
+
+class AsyncREPL(object):
+
+    # Same protocol as REPL, but the child is driven from the kernel's own
+    # event loop instead of a bridge process. The queues are asyncio queues
+    # carrying the same messages as REPL's.
+
+    def __init__(self, config, start=False):
+        # private subclass, so that per-cell state stays per instance
+        self.config = type(config.__name__, (config,), {})
+        self.inqueue = asyncio.Queue()
+        self.outqueue = asyncio.Queue()
+        self.status = ctypes.create_string_buffer(100)
+        self.health = ctypes.create_string_buffer(1000)
+        self.child = None
+        self.reader = None
+        self.task = None
+        self.writer = None
+        self.chunks = collections.deque()
+        self.wakeup = asyncio.Event()
+        # set to give up waiting for the scheduler
+        self.queued = None
+        # when the journal replay running now started
+        self.replaying = None
+        if start:
+            self.start()
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.repl())
+
+    def submit(self, num, code, epoch=0, stop_on_error=False, **options):
+        options['submitted'] = time.monotonic()
+        self.inqueue.put_nowait((num, code, epoch, stop_on_error, options))
+
+    def request(self, num, request, epoch=0, **options):
+        options['request'] = request
+        self.inqueue.put_nowait((num, None, epoch, False, options))
+
+    async def get_output(self):
+        return await self.outqueue.get()
+
+    def interrupt(self, num, sent=None):
+        # see REPL.interrupts
+        config = self.config
+        reader = self.reader
+        if sent is None:
+            sent = time.monotonic()
+        current = REPL.interrupts(config, num, sent)
+        if current and self.queued is not None:
+            self.queued.set()
+            return
+        if not current and self.replaying is None:
+            return
+        # no child started yet
+        if reader is None or reader.interrupted is not None:
+            return
+        reader.interrupted = time.monotonic()
+        try:
+            os.kill(self.child.pid, config.interrupt_signal)
+        except ProcessLookupError:
+            # read_output sees it exit
+            return
+        # the rest of a cell still being written would only run afterwards
+        if self.chunks:
+            self.chunks.clear()
+            self.chunks.append(b"\n")
+        self.write(config.interrupt_input)
+
+    def get_health(self):
+        return REPL.report_health(self.status, self.health)
+
+    def kill(self):
+        try:
+            self.child.kill()
+        except:
+            pass
+
+    async def stop(self):
+        # ends the REPL and its child, for good
+        for task in (self.task, self.writer):
+            if task is not None:
+                task.cancel()
+        if self.child is not None:
+            self.kill()
+            await self.child.wait()
+        atexit.unregister(self.kill)
+        if self.config.scheduler is not None:
+            self.config.scheduler.close()
+
+    async def repl(self):
+        config = self.config
+
+        # an ignored SIGINT (as ipykernel sets it) would be inherited by the
+        # child, and it could not be interrupted; a handler is not
+        if signal.getsignal(signal.SIGINT) == signal.SIG_IGN:
+            signal.signal(signal.SIGINT, lambda signum, frame: None)
+        atexit.register(self.kill)
+
+        restarts = 0
+        # set once a child is gone: see REPL.after_exit
+        restart = None
+        while True:
+            self.status.value = b"initializing"
+            if not await self.start_child():
+                self.status.value = b"exited"
+                REPL.set_health(self.health, pid=None)
+                if restart is not None:
+                    REPL.report_restart(config, self.outqueue, restart,
+                                        "starting it again failed",
+                                        failed=True)
+                    restart = None
+                if config.restore_image is not None:
+                    # start one without the checkpoint instead
+                    config.restore_image = None
+                    continue
+                # try again with the next cell, answering this one
+                await self.refuse_input(
+                    "{} could not be started".format(config.name))
+                restarts += 1
+                continue
+            REPL.set_health(self.health, pid=self.child.pid,
+                            restarts=restarts, cells=0)
+
+            replayed = 0
+            if restart is not None:
+                outcome = "it was restarted, and all its state is lost"
+                if restart[3] and config.journal:
+                    self.status.value = b"replaying"
+                    if config.scheduler is not None:
+                        await config.scheduler.acquire_async(
+                            lambda msg: None, asyncio.Event())
+                    started = time.monotonic()
+                    replayed = await self.replay(restart[0])
+                    if REPL.replay_stopped(config, self.reader, replayed):
+                        outcome = REPL.replay_interrupted(
+                            config, self.reader, replayed)
+                    elif replayed < len(config.journal):
+                        # the journal kills it: start afresh
+                        self.writer.cancel()
+                        self.kill()
+                        await self.child.wait()
+                        restart = REPL.replay_failed(config, restart,
+                                                     replayed, self.reader)
+                        restarts += 1
+                        continue
+                    else:
+                        outcome = REPL.replay_note(
+                            config, replayed, time.monotonic() - started)
+                    REPL.set_health(self.health, replayed=replayed)
+                REPL.report_restart(config, self.outqueue, restart, outcome)
+                restart = None
+
+            cells = 0
+
+            # main loop
+            while await self.read_output(self.reader):
+                self.status.value = b"awaiting input"
+                if not await self.feed_child():
+                    break
+                self.status.value = b"reading output"
+                cells += 1
+                REPL.set_health(self.health, cells=cells)
+
+            # the child exited, the watchdog killed it, or a restart was
+            # asked for
+            self.status.value = b"restarting"
+            self.writer.cancel()
+            self.kill()
+            exit_status = limits.explain(
+                config.resource_limits, self.child.pid,
+                REPL.describe_exit(await self.child.wait()))
+            reaped = REPL.reaped(config)
+            if reaped is not None:
+                exit_status = reaped
+                cells = max(cells, 1)
+            restarts += 1
+            REPL.set_health(self.health, pid=None, restarts=restarts,
+                            last_exit=exit_status)
+            msgs, restart, refusal = REPL.after_exit(
+                config, self.reader, exit_status, cells, replayed)
+            for msg in msgs:
+                self.outqueue.put_nowait(msg)
+            if refusal is not None:
+                self.status.value = b"exited"
+                await self.refuse_input(refusal)
+            elif reaped is not None:
+                self.status.value = b"terminated while idle"
+                config.held_input = await self.inqueue.get()
+
+    async def start_child(self):
+        # start and initialize child
+        config = self.config
+        config.input_num = None
+
+        # may build a startup image the first time
+        loop = asyncio.get_event_loop()
+        cmd, setup = await loop.run_in_executor(None, startup.prepare, config)
+
+        try:
+            self.child = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+                env=limits.child_env(config.resource_limits))
+        except OSError:
+            return False
+        REPL.apply_limits(config, self.child.pid)
+        self.reader = reader = OutputReader(config)
+        self.chunks.clear()
+        self.writer = asyncio.ensure_future(self.write_input())
+        REPL.register_child(config, self.child.pid, blocking=False)
+
+        if config.initial_input is not None:
+            self.write(config.initial_input)
+
+        if setup is not None:
+            if not await self.read_output(reader):
+                self.writer.cancel()
+                self.kill()
+                return False
+            text, err = REPL.prepare_input(config, setup)
+            if text is None:
+                sys.stderr.write("sjk: preamble not run: {}\n".format(err))
+                text = config.interrupt_input
+            self.write(text)
+        return True
+
+    def write(self, text):
+        # queued for write_input, as with REPL's InputWriter; but when
+        # nothing is waiting, the first chunk goes out right away instead of
+        # after whatever else the event loop has to do first
+        data = text.encode("utf8")
+        size = InputWriter.chunk_size
+        start = 0
+        stdin = self.child.stdin
+        if not self.chunks and not stdin.transport.get_write_buffer_size():
+            stdin.write(data[:size])
+            start = size
+        for start in range(start, len(data), size):
+            self.chunks.append(data[start:start+size])
+        self.wakeup.set()
+
+    async def write_input(self):
+        # one task per child, cancelled once it is gone
+        stdin = self.child.stdin
+        while True:
+            while not self.chunks:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            stdin.write(self.chunks.popleft())
+            try:
+                await stdin.drain()
+            except ConnectionError:
+                return
+
+    async def read_output(self, reader):
+        # False once the child has exited, or was killed by the watchdog
+        config = self.config
+        stdout = self.child.stdout
+        reader.start()
+        while not reader.done:
+            timeout = None
+            if config.input_num != None:
+                timeout = reader.stream_timeout()
+                if timeout == 0:
+                    for msg in REPL.stream_output(config, reader):
+                        self.outqueue.put_nowait(msg)
+                    continue
+                due = reader.watchdog_timeout()
+                if due == 0:
+                    if reader.interrupted is not None:
+                        reader.killed = True
+                        return False
+                    reader.timed_out = True
+                    self.interrupt(config.input_num)
+                    continue
+                if due is not None and (timeout is None or due < timeout):
+                    timeout = due
+            try:
+                data = await asyncio.wait_for(
+                    stdout.read(reader.chunk_size), timeout)
+            except asyncio.TimeoutError:
+                continue
+            if not data:
+                return False
+            reader.feed(data)
+        if reader.interrupted is not None and not await self.settle(reader):
+            return False
+        for msg in REPL.finish_output(config, reader):
+            self.outqueue.put_nowait(msg)
+        return True
+
+    async def settle(self, reader):
+        # see REPL.settle
         while True:
-            config.input_num, raw_code = inqueue.get()
-            status, code, err = config.syntaxchecker(raw_code)
-            if status == "complete":
+            try:
+                data = await asyncio.wait_for(
+                    self.child.stdout.read(reader.chunk_size),
+                    self.config.interrupt_settle)
+            except asyncio.TimeoutError:
                 break
+            if reader.watchdog_timeout() == 0:
+                reader.killed = True
+                return False
+            if not data:
+                return False
+        reader.discard()
+        return True
+
+    async def feed_child(self):
+        # False if the child died while waiting for input
+        config = self.config
+        if config.scheduler is not None:
+            config.scheduler.release()
+        exited = asyncio.ensure_future(self.child.wait())
+        get = None
+        try:
+            while True:
+                if config.held_input is not None:
+                    item, config.held_input = config.held_input, None
+                else:
+                    get = asyncio.ensure_future(self.inqueue.get())
+                    await asyncio.wait([get, exited],
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    if not get.done():
+                        get.cancel()
+                        # no cell is running
+                        config.input_num = None
+                        return False
+                    item = get.result()
+                handled, msg = REPL.handle_request(config, item)
+                if handled:
+                    if msg is None:
+                        return False
+                    self.outqueue.put_nowait(msg)
+                    continue
+                text, err = REPL.next_input(config, item)
+                if text is not None and await self.admit():
+                    break
+                if err is not None:
+                    self.outqueue.put_nowait((config.input_num, "error", err))
+        finally:
+            # the task itself may be cancelled while waiting (see stop)
+            exited.cancel()
+            if get is not None:
+                get.cancel()
+        if config.restart_notice is not None:
+            self.outqueue.put_nowait(
+                (config.input_num, "notice", config.restart_notice))
+            config.restart_notice = None
+        REPL.start_cell(config, self.child.pid)
+        self.write(text)
+        return True
+
+    async def admit(self):
+        # see REPL.admit
+        config = self.config
+        if config.scheduler is None:
+            return True
+        num = config.input_num
+        self.queued = asyncio.Event()
+        try:
+            waited = await config.scheduler.acquire_async(
+                lambda msg: self.outqueue.put_nowait(
+                    (num, "notice", REPL.queued_notice(msg))),
+                self.queued)
+        finally:
+            self.queued = None
+        for msg in REPL.admission(config, waited):
+            self.outqueue.put_nowait(msg)
+        return waited is not None
+
+    async def replay(self, num):
+        # see REPL.replay
+        config = self.config
+        reader = self.reader
+        if not await self.skip_output(reader):
+            return 0
+        total = len(config.journal)
+        shown = time.monotonic()
+        for n, (cell, code) in enumerate(config.journal):
+            text, err = REPL.prepare_input(config, code)
+            if text is None:
+                continue
+            self.write(text)
+            self.replaying = time.monotonic()
+            try:
+                ok = await self.replay_output(reader)
+            finally:
+                self.replaying = None
+            if not ok:
+                return n
+            reader.clear()
+            if reader.interrupted is not None:
+                reader.pending = config.prompt_char
+                return n
+            if num is not None and (time.monotonic() - shown
+                                    >= config.stream_interval):
+                self.outqueue.put_nowait(
+                    (num, "notice", "[replaying: {} of {} cells]\n".format(
+                        n + 1, total)))
+                shown = time.monotonic()
+        reader.pending = config.prompt_char + reader.pending
+        return total
+
+    async def replay_output(self, reader):
+        # see REPL.replay_output; interrupts come through interrupt, so the
+        # watchdog is looked at every watch_interval at least
+        config = self.config
+        stdout = self.child.stdout
+        reader.start()
+        while not reader.done:
+            due = reader.watchdog_timeout()
+            if due == 0:
+                if reader.interrupted is not None:
+                    reader.killed = True
+                    return False
+                reader.timed_out = True
+                self.interrupt(config.input_num)
+                continue
+            timeout = config.watch_interval
+            if due is not None:
+                timeout = min(due, timeout)
+            try:
+                data = await asyncio.wait_for(
+                    stdout.read(reader.chunk_size), timeout)
+            except asyncio.TimeoutError:
+                continue
+            if not data:
+                return False
+            reader.feed(data)
+        if reader.interrupted is not None:
+            return await self.settle(reader)
+        return True
+
+    async def skip_output(self, reader):
+        reader.start()
+        while not reader.done:
+            data = await self.child.stdout.read(reader.chunk_size)
+            if not data:
+                return False
+            reader.feed(data)
+        return True
+
+    async def refuse_input(self, note):
+        msg = None
+        while msg is None:
+            msg = REPL.refusal(self.config, await self.inqueue.get(), note)
+        self.outqueue.put_nowait(msg)
+
+
+###########################################################################
+
+parmap_re = re.compile(r"(?:-n\s*(\d+)\s+)?([A-Za-z_]\w*)\s*=\s*(.+?)"
+                       r"\s+for\s+(.+)")
+
+class WorkerPool(object):
+
+    # The extra children of %%parmap, each driven by an AsyncREPL on the
+    # kernel's event loop. They are kept for the next %%parmap with the
+    # same setup code, and started afresh for another one.
+
+    def __init__(self, config):
+        self.config = config
+        self.workers = []
+        self.setup = None
+        self.interrupted = False
+
+    async def start(self, size, setup):
+        # size workers for setup; returns the ones that still have to run it
+        self.interrupted = False
+        if setup != self.setup:
+            await self.stop()
+        while len(self.workers) > size:
+            await self.workers.pop().stop()
+        started = []
+        while len(self.workers) < size:
+            worker = AsyncREPL(self.config, start=True)
+            self.workers.append(worker)
+            started.append(worker)
+        self.setup = setup
+        return started
+
+    async def stop(self):
+        stopped = len(self.workers)
+        while self.workers:
+            await self.workers.pop().stop()
+        self.setup = None
+        return stopped
+
+    def interrupt(self):
+        # the cells running now are interrupted, and no more are started
+        self.interrupted = True
+        for worker in self.workers:
+            if worker.config.input_num is not None:
+                worker.interrupt(worker.config.input_num)
+
+class Job(object):
+
+    # A %%background cell. Its display shows the job's state and then its
+    # output; the (kind, outputs) messages the child sent are kept for
+    # %jobs N.
+
+    tail_lines = 20
+
+    def __init__(self, num, code, parent, seed=None):
+        self.num = num
+        self.code = code
+        self.parent = parent
+        self.seed = seed
+        self.display_id = "sjk-job-{}".format(uuid.uuid4().hex)
+        self.status = "starting"
+        self.started = time.monotonic()
+        self.finished = None
+        self.events = []
+        self.worker = None
+        self.task = None
+
+    def describe(self):
+        if self.finished is None:
+            return "job {}: {} for {:.1f} s".format(
+                self.num, self.status, time.monotonic() - self.started)
+        return "job {}: {} after {:.1f} s".format(
+            self.num, self.status, self.finished - self.started)
+
+    def report(self):
+        # the text for the job's display
+        text = []
+        displays = 0
+        for kind, outputs in self.events:
+            if kind == "ok":
+                text.append(outputs[0])
+                displays += len(outputs) - 1
+            elif kind == "display":
+                displays += 1
             else:
-                outqueue.put((config.input_num, False, err))
-        if config.use_intermediate_file:
-            config.intermediate_file = tempfile.NamedTemporaryFile('w+')
-            config.intermediate_file.write( code )
-            config.intermediate_file.flush()
-        child.stdin.write(config.input_cmd(
-            config.input_num, code, config.intermediate_file))
-        child.stdin.flush()
+                text.append(outputs)
+        text = "".join(text).rstrip("\n")
+        if self.finished is None:
+            text = "\n".join(text.splitlines()[-self.tail_lines:])
+        lines = [ "[{}]".format(self.describe()) ]
+        if displays:
+            lines.append("[{} more outputs: %jobs {} shows them]".format(
+                displays, self.num))
+        if text:
+            lines.append(text)
+        return "\n".join(lines)
+
+###########################################################################
+
+class InputWriter(object):
+
+    # Writes input to the child from its own thread, so that output is
+    # drained while a large cell is still being written: otherwise a CAS
+    # printing as it reads fills its stdout pipe, stops reading, and both
+    # sides block. Input goes out in chunks; cancel() drops the chunks not
+    # yet written and ends a line that was cut short.
+
+    chunk_size = 65536
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.chunks = collections.deque()
+        self.cond = threading.Condition()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def write(self, text):
+        data = text.encode("utf8")
+        with self.cond:
+            for start in range(0, len(data), self.chunk_size):
+                self.chunks.append(data[start:start+self.chunk_size])
+            self.cond.notify()
+
+    def cancel(self):
+        # a chunk being written is finished, and the last chunk of a cell
+        # ends its last line, so there is nothing to end if none is left
+        with self.cond:
+            if self.chunks:
+                self.chunks.clear()
+                self.chunks.append(b"\n")
+                self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.chunks:
+                    self.cond.wait()
+                chunk = self.chunks.popleft()
+            if chunk is None:
+                return
+            try:
+                view = memoryview(chunk)
+                while view:
+                    view = view[os.write(self.fd, view):]
+            except OSError:
+                # the child is gone; the reader sees it exit
+                return
+
+    def close(self):
+        with self.cond:
+            self.chunks.clear()
+            self.chunks.append(None)
+            self.cond.notify()
+
+###########################################################################
+
+class IntermediateFile(object):
+
+    # The file a cell is written to for backends that load their input from
+    # a file. There is one per session, rewritten in place for every cell.
+    # Where /proc is available the file has no name of its own: it is a
+    # memfd (or an unlinked file in /dev/shm or the temp dir) and the CAS
+    # opens it as /proc/<pid>/fd/<n>, so nothing is left behind either.
+
+    kind = os.environ.get("SJK_INTERMEDIATE", "memfd")
+
+    def __init__(self, kind=None):
+        kind = kind or self.kind
+        self.fd = None
+        self.path = None
+        if kind == "memfd" and hasattr(os, "memfd_create"):
+            try:
+                self.fd = os.memfd_create("sjk-cell", os.MFD_CLOEXEC)
+            except OSError:
+                pass
+        if self.fd is None:
+            directory = None
+            if kind != "tmp" and os.path.isdir("/dev/shm"):
+                directory = "/dev/shm"
+            self.fd, self.path = tempfile.mkstemp(prefix="sjk-", dir=directory)
+        procpath = "/proc/{}/fd/{}".format(os.getpid(), self.fd)
+        if os.path.exists(procpath):
+            if self.path is not None:
+                os.unlink(self.path)
+                self.path = None
+            self.name = procpath
+        else:
+            self.name = self.path
+            atexit.register(self.close)
+
+    def write(self, text):
+        # overwrite, then cut: truncating to zero first would free the pages
+        # only to allocate them again
+        data = text.encode("utf8")
+        view = memoryview(data)
+        offset = 0
+        while offset < len(data):
+            offset += os.pwrite(self.fd, view[offset:], offset)
+        os.ftruncate(self.fd, len(data))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.path is not None:
+            os.unlink(self.path)
+            self.path = None
+
+###########################################################################
+
+class OutputReader(object):
+
+    # Splits the raw byte stream of the child into output segments. Bytes are
+    # decoded incrementally, so multi-byte characters (the prompt char
+    # included) may be split across chunks; anything read past the prompt is
+    # kept for the next cell.
+
+    chunk_size = 65536
+
+    def __init__(self, config, fd=None):
+        self.config = config
+        self.fd = fd
+        self.decoder = codecs.getincrementaldecoder("utf8")(errors="replace")
+        self.pending = ""
+        self.segments = [[]]
+        self.spill = None
+        self.interrupted = None
+        self.timed_out = False
+        self.killed = False
+        self.done = False
+        self.scan_time = 0.0
+
+    def start(self):
+        if self.spill is not None:
+            self.spill.close()
+        self.segments = [[]]
+        self.flushed = 0
+        self.unflushed = 0
+        self.kept = 0
+        self.spill = None
+        self.spilled = 0
+        self.tail = ""
+        # the segment the budget ran out in, and whether later ones were
+        # spilled too
+        self.cut = 0
+        self.spill_split = False
+        self.streamed = False
+        self.interrupted = None
+        self.timed_out = False
+        self.killed = False
+        self.done = False
+        self.started = self.last_flush = time.monotonic()
+        # seconds spent in feed this cell
+        self.scan_time = 0.0
+        if self.pending:
+            self.scan("")
+
+    def feed(self, data):
+        started = time.perf_counter()
+        self.scan(self.decoder.decode(data))
+        self.scan_time += time.perf_counter() - started
+        return self.done
+
+    def scan(self, text):
+        if self.pending:
+            text = self.pending + text
+            self.pending = ""
+        end = text.find(self.config.prompt_char)
+        stop = len(text) if end < 0 else end
+        room = max(0, self.config.output_budget - self.kept)
+        if stop > room:
+            self.spill_output(text[room:stop])
+            stop = room
+        self.split(text[:stop])
+        if end >= 0:
+            self.pending = text[end+1:]
+            self.done = True
+
+    def split(self, text):
+        self.kept += len(text)
+        self.unflushed += len(text)
+        separator = self.config.output_separator
+        start = 0
+        if separator:
+            sep = text.find(separator)
+            while sep >= 0:
+                self.segments[-1].append(text[start:sep])
+                self.segments.append([])
+                start = sep + 1
+                sep = text.find(separator, start)
+        self.segments[-1].append(text[start:])
+
+    def spill_output(self, text):
+        # past the budget output only goes to the spill file, and memory
+        # use stays the same however much more there is
+        if not text:
+            return
+        if self.spill is None:
+            self.spill = tempfile.NamedTemporaryFile(
+                "w", encoding="utf8", prefix="sjk-output-", suffix=".txt",
+                dir=self.config.spill_dir, delete=False)
+            self.cut = len(self.segments) - 1
+        separator = self.config.output_separator
+        if separator and separator in text:
+            self.spill_split = True
+        self.spill.write(text)
+        self.spilled += len(text)
+        self.tail = (self.tail + text)[-self.config.output_tail:]
+
+    def stream_timeout(self):
+        # seconds until partial output should be forwarded, None if there
+        # is nothing to forward
+        config = self.config
+        if not self.unflushed:
+            return None
+        due = max(self.started + config.stream_delay,
+                  self.last_flush + config.stream_interval)
+        if self.unflushed >= config.stream_size:
+            due = self.started + config.stream_delay
+        return max(0, due - time.monotonic())
+
+    def watchdog_timeout(self):
+        # seconds until the cell is interrupted, or the child killed if it
+        # was interrupted already; None if that never happens
+        config = self.config
+        if self.interrupted is not None:
+            due = self.interrupted + config.kill_timeout
+        elif config.cell_timeout:
+            due = self.started + config.cell_timeout
+        else:
+            return None
+        return max(0, due - time.monotonic())
+
+    def take_partial(self, holdback=0):
+        # Hand out what can be forwarded before the prompt arrives: finished
+        # segments, and the complete lines of the first one. Forwarded
+        # segments are left empty so that indices keep their meaning.
+        text = ""
+        displays = []
+        last = len(self.segments) - 1
+        for n in range(self.flushed, last):
+            output = "".join(self.segments[n])
+            self.segments[n] = []
+            if n == 0:
+                text += output
+            elif output:
+                displays.append(output)
+        self.flushed = last
+        self.last_flush = time.monotonic()
+        if last == 0:
+            output = "".join(self.segments[0])
+            cut = len(output)
+            for i in range(holdback + 1):
+                cut = output.rfind("\n", 0, cut)
+                if cut < 0:
+                    break
+            if cut >= 0:
+                text += output[:cut+1]
+                self.segments[0] = [output[cut+1:]]
+        self.unflushed = 0
+        if text:
+            self.streamed = True
+        return text, displays
+
+    def clear(self):
+        # forget the output read so far, for output nobody will see
+        if self.spill is not None:
+            self.spill.close()
+            os.unlink(self.spill.name)
+            self.spill = None
+
+    def discard(self):
+        # drop anything read past the prompt, e.g. after an interrupt
+        self.pending = ""
+        self.decoder.reset()
+
+    def outputs(self):
+        outputs = [ "".join(segment) for segment in self.segments ]
+        if self.spill is not None:
+            self.spill.close()
+            tail = self.tail
+            dropped = 0
+            if self.cut > 0:
+                # a display cut short would not parse, so it is left out
+                dropped = len(outputs[self.cut])
+                outputs[self.cut] = ""
+            if self.cut > 0 or self.spill_split:
+                # and the tail would be part of one
+                tail = ""
+            elif len(tail) < self.spilled and "\n" in tail[:-1]:
+                tail = tail[tail.index("\n")+1:]
+            outputs[0] += "\n[... {} characters not shown; the output from " \
+                          "here on is in {} ...]\n{}".format(
+                              self.spilled + dropped - len(tail),
+                              self.spill.name, tail)
+            self.spill = None
+        return outputs
 
 
 ###########################################################################
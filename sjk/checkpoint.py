@@ -0,0 +1,120 @@
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from . import startup
+
+###########################################################################
+
+# A checkpoint is a session saved by the CAS itself (%checkpoint, with the
+# backend's checkpoint_cmd), compressed, and stored per backend with a JSON
+# file saying what saved it and when. They are kept in SJK_CHECKPOINT_DIR,
+# by default ~/.local/share/sjk/checkpoints, and can be copied to another
+# machine along with it.
+
+# checkpoints are compressed while the user waits: favour speed
+compress_level = 1
+
+name_re = re.compile(r"\w[\w.-]*")
+
+def checkpoint_dir(config):
+    base = os.environ.get("SJK_CHECKPOINT_DIR")
+    if not base:
+        data = (os.environ.get("XDG_DATA_HOME")
+                or os.path.expanduser("~/.local/share"))
+        base = os.path.join(data, "sjk", "checkpoints")
+    return os.path.join(base, config.name)
+
+def paths(config, name):
+    if not name_re.fullmatch(name):
+        raise ValueError("bad checkpoint name: {!r} (letters, digits, "
+                         "'_', '.' and '-' only)".format(name))
+    base = os.path.join(checkpoint_dir(config), name)
+    return base + ".gz", base + ".json"
+
+def scratch(config):
+    # an empty file for the CAS to save a session to, or load it from
+    directory = checkpoint_dir(config)
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix=".sjk-", suffix=".raw", dir=directory)
+    os.close(fd)
+    return path
+
+def save(config, name, raw, seconds):
+    # compresses raw, as saved by the CAS in seconds, into checkpoint name
+    data, meta = paths(config, name)
+    started = time.monotonic()
+    tmp = data + ".tmp"
+    with open(raw, "rb") as src:
+        with gzip.open(tmp, "wb", compresslevel=compress_level) as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+    os.replace(tmp, data)
+    info = {
+        'backend': config.name,
+        'cmd': config.cmd,
+        'binary': startup.binary_key(config),
+        'size': os.path.getsize(raw),
+        'compressed_size': os.path.getsize(data),
+        'saved': time.time(),
+        'save_time': seconds + time.monotonic() - started,
+    }
+    with open(meta + ".tmp", "w") as f:
+        json.dump(info, f, indent=1)
+    os.replace(meta + ".tmp", meta)
+    os.unlink(raw)
+    return info
+
+def load(config, name):
+    # decompresses checkpoint name into a scratch file; returns its path
+    # and the checkpoint's metadata
+    data, meta = paths(config, name)
+    if not os.path.exists(data):
+        raise ValueError("no checkpoint {!r} in {}".format(
+            name, checkpoint_dir(config)))
+    with open(meta) as f:
+        info = json.load(f)
+    if info['backend'] != config.name:
+        raise ValueError("checkpoint {!r} is from {}".format(
+            name, info['backend']))
+    raw = scratch(config)
+    try:
+        with gzip.open(data, "rb") as src, open(raw, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+    except:
+        os.unlink(raw)
+        raise
+    return raw, info
+
+def list_checkpoints(config):
+    checkpoints = []
+    directory = checkpoint_dir(config)
+    if not os.path.isdir(directory):
+        return checkpoints
+    for entry in sorted(os.listdir(directory)):
+        if not entry.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, entry)) as f:
+                checkpoints.append((entry[:-5], json.load(f)))
+        except (OSError, ValueError):
+            pass
+    return checkpoints
+
+def describe(name, info):
+    return "{}: {} ({} compressed), saved {} in {:.2f} s".format(
+        name, format_size(info['size']), format_size(info['compressed_size']),
+        time.strftime("%Y-%m-%d %H:%M", time.localtime(info['saved'])),
+        info['save_time'])
+
+def format_size(size):
+    for unit in ("bytes", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            break
+        size /= 1024
+    if unit == "bytes":
+        return "{} bytes".format(size)
+    return "{:.1f} {}".format(size, unit)
@@ -1,4 +1,5 @@
 
+import json
 import textwrap
 
 from .cas_kernel import CasKernel, CasConfig
@@ -8,6 +9,7 @@ from .syntax import gap as gap_syntax
 
 class GapConfig(CasConfig):
 
+    name = "gap"
     prompt_char = "\u2192"
     prompt_cmd = "Print(\"{}\");".format(prompt_char)
     cmd = \
@@ -18,6 +20,35 @@ class GapConfig(CasConfig):
          ]
     initial_input = prompt_cmd + "\n"
     use_intermediate_file = False # terrible, I know
+    file_input_threshold = 65536
+    interrupt_input = prompt_cmd + "\n" # -T: no brk> loop to leave
+    chdir_cmd = "ChangeDirectoryCurrent({});;"
+    save_image_cmd = "SaveWorkspace({});;"
+    image_args = [ "-L", "{}" ]
+    checkpoint_cmd = save_image_cmd
+    list_assign_cmd = "{name} := [ {items} ];;"
+    # needs the IO package; the template reaps its children itself
+    fork_setup = textwrap.dedent("""\
+        LoadPackage("io", false);;
+        BindGlobal("SJK_Fork", function(input, output)
+            local pid, fd;
+            pid := IO_fork();
+            if pid = 0 then
+                IO_setsid();
+                fd := IO_open(input, IO.O_RDONLY, 0);
+                IO_dup2(fd, 0);
+                IO_close(fd);
+                fd := IO_open(output, IO.O_WRONLY, 0);
+                IO_dup2(fd, 1);
+                IO_dup2(fd, 2);
+                IO_close(fd);
+            elif pid > 0 then
+                IO_IgnorePid(pid);
+                Print(pid, "\\n");
+            fi;
+        end);;
+        """)
+    fork_cmd = "SJK_Fork({}, {});;"
 
     @classmethod
     def syntaxchecker(cls, code):
@@ -27,12 +58,29 @@ class GapConfig(CasConfig):
     def input_cmd(cls, input_num, cmd_list, intermediate_file):
         if not cmd_list:
             return cls.prompt_cmd + "\n"
-        ret = ""
-        for cmd, cmd_end in cmd_list:
-            ret += cmd
+        # Read does not print results, so only the leading statements whose
+        # results are not printed anyway (";;") can go through the file
+        quiet = cls.quiet_prefix(cmd_list)
+        head = "".join(cmd for cmd, cmd_end in cmd_list[:quiet])
+        ret = "".join(cmd for cmd, cmd_end in cmd_list[quiet:])
+        if cls.file_input(len(head)):
+            intermediate_file.write(head)
+            ret = "Read({});\n{}".format(
+                json.dumps(intermediate_file.name), ret)
+        else:
+            ret = head + ret
         return "{}{}\n".format(ret, cls.prompt_cmd) # fingers crossed!!
-        # return "load(\"{}\")$\n{}\n".format(
-        #     intermediate_file.name, cls.prompt_cmd)
+
+    @staticmethod
+    def quiet_prefix(cmd_list):
+        # "x;;" comes as a ";" block followed by a ";;" block
+        quiet = 0
+        for i, (cmd, cmd_end) in enumerate(cmd_list):
+            if cmd_end == ";;":
+                quiet = i + 1
+            elif i + 1 == len(cmd_list) or cmd_list[i+1][1] != ";;":
+                break
+        return quiet
 
 
 class GapKernel(CasKernel):
@@ -0,0 +1,181 @@
+import errno
+import os
+import re
+import resource
+
+from .checkpoint import format_size
+
+###########################################################################
+
+# Limits on the CAS processes, from SJK_* variables (set per backend in the
+# env section of its kernelspec). They are applied to a child right after
+# it is started, or adopted from a pool, by pid:
+#
+#   SJK_MEMORY_LIMIT   e.g. 4G: address space (RLIMIT_AS), or memory
+#                      without swap (memory.max) with SJK_CGROUP
+#   SJK_CGROUP         a cgroup v2 directory the kernel may write to; each
+#                      child gets a group of its own in it
+#   SJK_CPUS           CPUs the child runs on, e.g. 0-3,8 or node1 for
+#                      those of a NUMA node (whose memory it then uses,
+#                      with SJK_CGROUP and the cpuset controller)
+#   SJK_NICE           niceness
+#   SJK_THREADS        threads for OpenMP, BLAS and the like, through
+#                      thread_env (set in the child's environment)
+#
+# CPUs and niceness are per thread, so they are set on each thread the
+# child has by then; threads it starts later inherit them. SJK_THREADS
+# only reaches children started with it in their environment: a pooled
+# child gets the pool daemon's instead.
+
+thread_env = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+              "GOTO_NUM_THREADS", "BLIS_NUM_THREADS", "VECLIB_MAXIMUM_THREADS",
+              "NUMEXPR_NUM_THREADS"]
+
+size_re = re.compile(r"(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?", re.I)
+
+def parse_size(text):
+    m = size_re.fullmatch(text.strip())
+    if m is None:
+        raise ValueError("bad size: {!r} (use e.g. 512M or 4G)".format(text))
+    unit = m.group(2).lower()
+    return int(float(m.group(1)) * 1024 ** ("kmgt".index(unit) + 1
+                                           if unit else 0))
+
+def node_cpus(node):
+    path = "/sys/devices/system/node/node{}/cpulist".format(node)
+    try:
+        with open(path) as f:
+            return parse_cpus(f.read())[0]
+    except OSError:
+        raise ValueError("no NUMA node {}".format(node))
+
+def parse_cpus(text):
+    # (CPUs, NUMA nodes named) from e.g. 0-3,8,node1
+    cpus = set()
+    nodes = set()
+    for item in text.replace(" ", "").split(","):
+        if not item:
+            continue
+        if item.startswith("node"):
+            nodes.add(int(item[4:]))
+            cpus |= node_cpus(int(item[4:]))
+            continue
+        first, sep, last = item.partition("-")
+        if not (first.isdigit() and (not sep or last.isdigit())):
+            raise ValueError("bad CPU list: {!r} (use e.g. 0-3,8 or "
+                             "node1)".format(text))
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus, nodes
+
+def from_env(environ=os.environ):
+    limits = {}
+    if environ.get("SJK_MEMORY_LIMIT"):
+        limits['memory'] = parse_size(environ["SJK_MEMORY_LIMIT"])
+    if environ.get("SJK_CGROUP"):
+        limits['cgroup'] = environ["SJK_CGROUP"]
+    if environ.get("SJK_CPUS"):
+        limits['cpus'], limits['nodes'] = parse_cpus(environ["SJK_CPUS"])
+    if environ.get("SJK_NICE"):
+        limits['nice'] = int(environ["SJK_NICE"])
+    if environ.get("SJK_THREADS"):
+        limits['threads'] = int(environ["SJK_THREADS"])
+    return limits
+
+def child_env(limits):
+    # the environment to start a child with; None to inherit the kernel's
+    if 'threads' not in limits:
+        return None
+    env = dict(os.environ)
+    for name in thread_env:
+        env[name] = str(limits['threads'])
+    return env
+
+def cgroup_path(limits, pid):
+    return os.path.join(limits['cgroup'], "sjk-{}".format(pid))
+
+def write(directory, name, value):
+    # False if the controller is not there
+    try:
+        with open(os.path.join(directory, name), "w") as f:
+            f.write(value)
+    except FileNotFoundError:
+        return False
+    return True
+
+def tasks(pid):
+    # the thread ids of process pid
+    try:
+        return [ int(tid) for tid in os.listdir("/proc/{}/task".format(pid)) ]
+    except OSError:
+        return [pid]
+
+def apply(limits, pid):
+    # applies limits to child pid; what could not be, as a message
+    failed = []
+    if 'cgroup' in limits:
+        group = cgroup_path(limits, pid)
+        try:
+            os.makedirs(group, exist_ok=True)
+            if 'memory' in limits:
+                if not write(group, "memory.max", str(limits['memory'])):
+                    failed.append("memory.max (is the memory controller "
+                                  "enabled in {}?)".format(limits['cgroup']))
+                write(group, "memory.swap.max", "0")
+            if limits.get('nodes'):
+                write(group, "cpuset.cpus",
+                      ",".join(map(str, sorted(limits['cpus']))))
+                write(group, "cpuset.mems",
+                      ",".join(map(str, sorted(limits['nodes']))))
+            write(group, "cgroup.procs", str(pid))
+        except OSError as e:
+            failed.append("cgroup {}: {}".format(group, e.strerror))
+    elif 'memory' in limits:
+        try:
+            resource.prlimit(pid, resource.RLIMIT_AS,
+                             (limits['memory'], limits['memory']))
+        except OSError as e:
+            failed.append("memory limit: {}".format(e.strerror))
+    for tid in tasks(pid):
+        try:
+            if 'cpus' in limits:
+                os.sched_setaffinity(tid, limits['cpus'])
+            if 'nice' in limits:
+                os.setpriority(os.PRIO_PROCESS, tid, limits['nice'])
+        except OSError as e:
+            # ESRCH: a thread that has exited since
+            if e.errno != errno.ESRCH:
+                failed.append("CPUs and niceness: {}".format(e.strerror))
+                break
+    if failed:
+        return "limits not applied to pid {}: {}".format(
+            pid, "; ".join(failed))
+    return None
+
+def explain(limits, pid, exit_status):
+    # once child pid has exited: exit_status, saying so if a limit killed
+    # it; its cgroup is removed
+    oom = False
+    if 'cgroup' in limits:
+        group = cgroup_path(limits, pid)
+        try:
+            with open(os.path.join(group, "memory.events")) as f:
+                for line in f:
+                    key, value = line.split()
+                    if key == "oom_kill" and int(value):
+                        oom = True
+        except OSError:
+            pass
+        try:
+            os.rmdir(group)
+        except OSError:
+            pass
+    if 'memory' not in limits:
+        return exit_status
+    limit = format_size(limits['memory'])
+    if oom:
+        return ("was killed for using more than its memory limit of {} "
+                "(SJK_MEMORY_LIMIT)".format(limit))
+    if 'cgroup' in limits or exit_status == "exited with status 0":
+        return exit_status
+    return ("{} (SJK_MEMORY_LIMIT limits it to {} of address space, which "
+            "may be why)".format(exit_status, limit))
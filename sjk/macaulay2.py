@@ -9,6 +9,7 @@ from .cas_kernel import CasKernel, CasConfig
 
 class Macaulay2Config(CasConfig):
 
+    name = "macaulay2"
     prompt_char = "\u2192"
     prompt_cmd = "<< utf8 {} << flush;".format(ord(prompt_char))
     cmd = \
@@ -22,17 +23,30 @@ class Macaulay2Config(CasConfig):
          , "-e", prompt_cmd
          ]
     use_intermediate_file = False
+    file_input_threshold = 16384
+    chdir_cmd = "changeDirectory {};"
+    list_assign_cmd = "{name} = {{ {items} }};"
     initial_input = None
+    stream_holdback = 2
+    interrupt_input = prompt_cmd + "\n"
 
     @classmethod
     def input_cmd(cls, input_num, code, intermediate_file):
+        if cls.file_input(len(code)):
+            intermediate_file.write(code)
+            source = "get {}".format(json.dumps(intermediate_file.name))
+        else:
+            source = json.dumps(code)
         if len(code)>0 and code[-1] == ";":
-            return "value {};\n{}\n".format(json.dumps(code), cls.prompt_cmd)
+            return "value {};\n{}\n".format(source, cls.prompt_cmd)
         else:
-            return "value {}\n{}\n".format(json.dumps(code), cls.prompt_cmd)
+            return "value {}\n{}\n".format(source, cls.prompt_cmd)
 
     @classmethod
     def output_filter(cls, input_num, output, intermediate_file):
+        if input_num is not None and intermediate_file is not None:
+            cell = "cell {}".format(input_num)
+            output = output.replace(intermediate_file.name, cell)
         out_lines = output.splitlines()
         if len(out_lines) > 2 and out_lines[-2] == "":
             out_lines[-1] = re.sub("^\s*o\d*\s*:\s*","",out_lines[-1])
@@ -41,6 +55,13 @@ class Macaulay2Config(CasConfig):
         output = "\n".join(out_lines)
         return output
 
+    @classmethod
+    def stream_filter(cls, input_num, output, intermediate_file):
+        if input_num is not None and intermediate_file is not None:
+            cell = "cell {}".format(input_num)
+            output = output.replace(intermediate_file.name, cell)
+        return output
+
 
 class Macaulay2Kernel(CasKernel):
 
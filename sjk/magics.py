@@ -0,0 +1,57 @@
+import collections
+import re
+
+###########################################################################
+
+# Kernel magics. A cell whose first line is "%name args" is a line magic,
+# one whose first line is "%%name args" a cell magic with the rest of the
+# cell as its body. The kernel handles those it has a magic_<name> method
+# for; any other cell, unknown magics included, goes to the CAS unchanged.
+
+Magic = collections.namedtuple("Magic", "name args body cell")
+
+magic_re = re.compile(r"\s*(%%?)([A-Za-z_]\w*)[ \t]*(.*)")
+
+def parse(code):
+    first, newline, body = code.lstrip("\n").partition("\n")
+    match = magic_re.fullmatch(first)
+    if match is None:
+        return None
+    marker, name, args = match.groups()
+    return Magic(name, args.strip(), body, marker == "%%")
+
+range_re = re.compile(r"\s*(-?\d+)\s*\.\.\s*(-?\d+)\s*")
+
+def split_items(text):
+    # "a..b" as the integers from a to b, or else the comma separated
+    # items of text, leaving alone commas in brackets and strings
+    match = range_re.fullmatch(text)
+    if match is not None:
+        first, last = map(int, match.groups())
+        return [ str(n) for n in range(first, last + 1) ]
+    items = []
+    start = 0
+    depth = 0
+    quote = None
+    escaped = False
+    for i, char in enumerate(text):
+        if quote is not None:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in "\"'":
+            quote = char
+        elif char in "([{":
+            depth += 1
+        elif char in ")]}":
+            depth -= 1
+        elif char == "," and depth == 0:
+            items.append(text[start:i].strip())
+            start = i + 1
+    items.append(text[start:].strip())
+    if quote is not None or depth != 0 or not all(items):
+        raise ValueError("cannot split into items: {}".format(text.strip()))
+    return items
@@ -7,6 +7,7 @@ from .cas_kernel import CasKernel, CasConfig
 
 class MathematicaConfig(CasConfig):
 
+    name = "mathematica"
     prompt_char = "\u2192"
     output_separator = "\u0001"
     prompt_cmd = ""
@@ -43,6 +44,9 @@ class MathematicaConfig(CasConfig):
         ]
     """.strip() + "\n"
     use_intermediate_file = True
+    list_assign_cmd = "{name} = {{ {items} }};"
+    # "abort" at the Interrupt> menu also ends the loop above: restart it
+    interrupt_input = "a\n" + initial_input
 
     @classmethod
     def input_cmd(cls, inputnum, code, intermediate_file):
@@ -0,0 +1,116 @@
+import array
+import bisect
+import collections
+import re
+import uuid
+
+###########################################################################
+
+class OutputStore(object):
+
+    # Long text outputs are kept on the kernel side: the notebook gets the
+    # first page, and a frontend that knows the mimetype below fetches more
+    # pages, or the lines matching a pattern, through the comm target. The
+    # oldest outputs are dropped once the store holds max_size characters.
+    #
+    # Requests (comm_msg data) and their replies:
+    #   {request: "page", id, start, count} -> {text, start, count, total}
+    #   {request: "grep", id, pattern, limit} -> {matches: [[line, text]]}
+    # Replies also echo request, id and seq, or carry an error.
+
+    comm_target = "sjk.output"
+    mimetype = "application/vnd.sjk.output+json"
+    max_size = 64 * 2**20
+    grep_limit = 1000
+
+    def __init__(self, page_lines):
+        self.page_lines = page_lines
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def page(self, text):
+        # data for the first page of text, or None if it fits in one (or
+        # there is no paging)
+        if (self.page_lines is None
+                or text.count("\n", 0, -1) < self.page_lines):
+            return None
+        output_id, total = self.add(text)
+        start, stop, head = self.lines(output_id, 0, self.page_lines)
+        note = "[... showing {} of {} lines ...]".format(self.page_lines,
+                                                          total)
+        return {
+            'text/plain': head + note,
+            self.mimetype: {
+                'id': output_id,
+                'comm_target': self.comm_target,
+                'page_lines': self.page_lines,
+                'total': total,
+            },
+        }
+
+    def add(self, text):
+        # offsets[n] is where line n starts; the last one is the end
+        offsets = array.array("q", [0])
+        end = text.find("\n")
+        while end >= 0:
+            offsets.append(end + 1)
+            end = text.find("\n", end + 1)
+        if offsets[-1] != len(text):
+            offsets.append(len(text))
+        output_id = uuid.uuid4().hex
+        self.entries[output_id] = (text, offsets)
+        self.size += len(text)
+        while self.size > self.max_size and len(self.entries) > 1:
+            old_text, old_offsets = self.entries.popitem(last=False)[1]
+            self.size -= len(old_text)
+        return output_id, len(offsets) - 1
+
+    def lines(self, output_id, start, count):
+        text, offsets = self.entries[output_id]
+        start = min(max(0, start), len(offsets) - 1)
+        stop = min(start + max(0, count), len(offsets) - 1)
+        return start, stop, text[offsets[start]:offsets[stop]]
+
+    def grep(self, output_id, pattern, limit):
+        text, offsets = self.entries[output_id]
+        matches = []
+        last = -1
+        for match in re.finditer(pattern, text, re.MULTILINE):
+            line = bisect.bisect_right(offsets, match.start()) - 1
+            if line == last:
+                continue
+            last = line
+            matches.append([line, text[offsets[line]:offsets[line+1]]])
+            if len(matches) >= limit:
+                break
+        return matches
+
+    def open_comm(self, comm, msg):
+        comm.on_msg(lambda msg: comm.send(self.handle(msg['content']['data'])))
+
+    def handle(self, data):
+        request = data.get('request')
+        output_id = data.get('id')
+        reply = {'request': request, 'id': output_id, 'seq': data.get('seq')}
+        if output_id not in self.entries:
+            reply['error'] = ("unknown output (dropped, or from another "
+                              "session)")
+            return reply
+        try:
+            if request == "page":
+                start, stop, text = self.lines(
+                    output_id, int(data.get('start', 0)),
+                    int(data.get('count', self.page_lines)))
+                reply['text'] = text
+                reply['start'] = start
+                reply['count'] = stop - start
+                reply['total'] = len(self.entries[output_id][1]) - 1
+            elif request == "grep":
+                limit = min(int(data.get('limit', self.grep_limit)),
+                            self.grep_limit)
+                reply['matches'] = self.grep(output_id, data['pattern'], limit)
+            else:
+                reply['error'] = "unknown request: {}".format(request)
+        except (KeyError, TypeError, ValueError, re.error) as e:
+            reply['error'] = "bad request: {}".format(e)
+        return reply
@@ -0,0 +1,538 @@
+import argparse
+import array
+import collections
+import errno
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from . import backends, startup
+from .cas_kernel import REPL, OutputReader
+
+###########################################################################
+
+def default_socket():
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return os.path.join(runtime, "sjk-pool.sock")
+    return os.path.join(tempfile.gettempdir(),
+                        "sjk-pool-{}.sock".format(os.getuid()))
+
+def send_message(sock, msg, fds=()):
+    data = (json.dumps(msg) + "\n").encode("utf8")
+    if fds:
+        rights = array.array("i", fds)
+        sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, rights)])
+    else:
+        sock.sendall(data)
+
+def recv_message(sock, maxfds=0):
+    data = b""
+    fds = []
+    ancbufsize = socket.CMSG_SPACE(maxfds * 4) if maxfds else 0
+    while not data.endswith(b"\n"):
+        chunk, ancdata, flags, addr = sock.recvmsg(65536, ancbufsize)
+        for level, kind, payload in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                rights = array.array("i")
+                rights.frombytes(payload[:len(payload) - len(payload) % 4])
+                fds.extend(rights)
+        if not chunk:
+            break
+        data += chunk
+    if not data.endswith(b"\n"):
+        return None, fds
+    return json.loads(data.decode("utf8")), fds
+
+###########################################################################
+
+class AdoptedChild(object):
+
+    # The parts of subprocess.Popen that REPL uses, for a child whose
+    # parent is the pool daemon. The daemon reaps it once it exits.
+
+    def __init__(self, pid, stdin_fd, stdout_fd):
+        self.pid = pid
+        self.stdin = open(stdin_fd, "w", encoding="utf8", errors="replace")
+        self.stdout = open(stdout_fd, "rb", buffering=0)
+        self.returncode = None
+        self.pending = ""
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, 0)
+            except ProcessLookupError:
+                self.returncode = -1
+        return self.returncode
+
+    def wait(self):
+        # the daemon gets the exit status: None stands for it
+        while self.poll() is None:
+            time.sleep(0.05)
+        return None
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def adopt(config, path, timeout=5):
+    started = time.monotonic()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    fds = []
+    try:
+        sock.connect(path)
+        send_message(sock, {'op': 'adopt',
+                            'backend': config.name,
+                            'cwd': os.getcwd(),
+                            'profile': startup.profile_key()})
+        reply, fds = recv_message(sock, maxfds=2)
+        if not reply or reply.get('pid') is None or len(fds) != 2:
+            for fd in fds:
+                os.close(fd)
+            return None
+        child = AdoptedChild(reply['pid'], fds[0], fds[1])
+        if reply['chdir']:
+            child.stdin.write(config.chdir_input(os.getcwd()))
+            child.stdin.flush()
+            child.pending = reply['pending']
+        else:
+            # the pool already read the first prompt: put it back
+            child.pending = config.prompt_char + reply['pending']
+        send_message(sock, {'op': 'adopted',
+                            'latency': time.monotonic() - started})
+        return child
+    except (OSError, ValueError):
+        return None
+    finally:
+        sock.close()
+
+def memory_usage(pid):
+    # resident, proportional and unique (private) memory of a process, in
+    # bytes; forked children share the rest with their template
+    fields = {'Rss': 'rss', 'Pss': 'pss',
+              'Private_Clean': 'uss', 'Private_Dirty': 'uss'}
+    usage = dict(rss=0, pss=0, uss=0)
+    try:
+        with open("/proc/{}/smaps_rollup".format(pid)) as f:
+            for line in f:
+                field, _, value = line.partition(":")
+                if field in fields:
+                    usage[fields[field]] += int(value.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        return None
+    return usage
+
+def get_stats(path, timeout=5):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        send_message(sock, {'op': 'stats'})
+        return recv_message(sock)[0]
+    finally:
+        sock.close()
+
+###########################################################################
+
+class ForkServer(object):
+
+    # A template child, initialized once, that forks a new child for each
+    # session (see CasConfig.fork_input). Each new child gets two FIFOs
+    # as its input and output, whose other ends are handed over like a
+    # pooled child's pipes; it shares the template's memory copy-on-write
+    # until either writes to it.
+
+    def __init__(self, config, child, reader):
+        self.config = config
+        self.child = child
+        self.reader = reader
+        self.lock = threading.Lock()
+
+    @classmethod
+    def start(cls, config, cmd, setup, timeout):
+        deadline = time.monotonic() + timeout
+        child, reader = REPL.boot(config, cmd, setup, timeout)
+        if child is None:
+            return None
+        text, err = REPL.prepare_input(config, config.fork_setup)
+        child.stdin.write(text)
+        child.stdin.flush()
+        if not REPL.skip_output(reader, deadline):
+            child.kill()
+            child.wait()
+            return None
+        return cls(config, child, reader)
+
+    def alive(self):
+        return self.child.poll() is None
+
+    def close(self):
+        self.child.kill()
+        self.child.wait()
+
+    def fork(self, timeout):
+        # a new child that has printed its prompt, as (AdoptedChild,
+        # pending output), or None
+        config = self.config
+        deadline = time.monotonic() + timeout
+        tmp = tempfile.mkdtemp(prefix="sjk-fork-")
+        input_path = os.path.join(tmp, "input")
+        output_path = os.path.join(tmp, "output")
+        input_fd = output_fd = None
+        try:
+            os.mkfifo(input_path, 0o600)
+            os.mkfifo(output_path, 0o600)
+            output_fd = os.open(output_path, os.O_RDONLY | os.O_NONBLOCK)
+            with self.lock:
+                self.child.stdin.write(
+                    config.fork_input(input_path, output_path))
+                self.child.stdin.flush()
+                if not REPL.skip_output(self.reader, deadline):
+                    return None
+                pid = int(self.reader.outputs()[0].split()[-1])
+            # the new child opens its input first, and waits there until
+            # the other end is opened
+            while input_fd is None:
+                try:
+                    input_fd = os.open(input_path, os.O_WRONLY | os.O_NONBLOCK)
+                except OSError as e:
+                    if e.errno != errno.ENXIO:
+                        raise
+                    if time.monotonic() > deadline:
+                        os.kill(pid, signal.SIGKILL)
+                        return None
+                    os.kill(pid, 0)
+                    time.sleep(0.001)
+            os.set_blocking(input_fd, True)
+            os.set_blocking(output_fd, True)
+            reader = OutputReader(config, output_fd)
+            if not REPL.skip_output(reader, deadline):
+                os.kill(pid, signal.SIGKILL)
+                return None
+            child = AdoptedChild(pid, input_fd, output_fd)
+            input_fd = output_fd = None
+            return child, reader.pending
+        except (OSError, ValueError, IndexError):
+            return None
+        finally:
+            for fd in (input_fd, output_fd):
+                if fd is not None:
+                    os.close(fd)
+            for path in (input_path, output_path):
+                if os.path.exists(path):
+                    os.unlink(path)
+            os.rmdir(tmp)
+
+
+class Pool(object):
+
+    boot_timeout = 300
+    fork_timeout = 10
+    retry_delay = 10
+
+    def __init__(self, names, size, fork=False):
+        self.size = size
+        self.configs = { name: backends.get_config(name) for name in names }
+        self.ready = { name: collections.deque() for name in names }
+        self.wakeup = { name: threading.Event() for name in names }
+        self.stats = {
+            name: dict(hits=0, misses=0, booted=0, failed=0,
+                       boot_time=0.0, adopt_time=0.0, last_adopt_time=None,
+                       forks=0, fork_time=0.0, last_fork_time=None)
+            for name in names }
+        # backends whose sessions are forked from a template (ForkServer)
+        # instead of booted ahead of time
+        self.forking = { name for name, config in self.configs.items()
+                         if fork and config.fork_cmd is not None }
+        self.servers = {}
+        self.adopted = []
+        self.profile = startup.profile_key()
+        self.lock = threading.Lock()
+
+    def start(self):
+        for name in self.configs:
+            thread = threading.Thread(target=self.replenish, args=(name,))
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        with self.lock:
+            for ready in self.ready.values():
+                for child, pending in ready:
+                    child.kill()
+            for server in self.servers.values():
+                server.close()
+
+    def replenish(self, name):
+        config = self.configs[name]
+        stats = self.stats[name]
+        cmd, setup = startup.prepare(config)
+        if name in self.forking:
+            self.keep_server(name, cmd, setup)
+        while True:
+            self.reap()
+            while len(self.ready[name]) < self.size:
+                started = time.monotonic()
+                entry = self.boot(config, cmd, setup)
+                with self.lock:
+                    if entry is None:
+                        stats['failed'] += 1
+                    else:
+                        stats['booted'] += 1
+                        stats['boot_time'] += time.monotonic() - started
+                        self.ready[name].append(entry)
+                if entry is None:
+                    time.sleep(self.retry_delay)
+                    break
+            self.wakeup[name].wait(1.0)
+            self.wakeup[name].clear()
+
+    def keep_server(self, name, cmd, setup):
+        # (re)starts the template whenever it is gone
+        config = self.configs[name]
+        stats = self.stats[name]
+        while True:
+            self.reap()
+            server = self.servers.get(name)
+            if server is None or not server.alive():
+                started = time.monotonic()
+                server = ForkServer.start(config, cmd, setup,
+                                          self.boot_timeout)
+                with self.lock:
+                    if server is None:
+                        self.servers.pop(name, None)
+                        stats['failed'] += 1
+                    else:
+                        self.servers[name] = server
+                        stats['booted'] += 1
+                        stats['boot_time'] += time.monotonic() - started
+                if server is None:
+                    time.sleep(self.retry_delay)
+                    continue
+            self.wakeup[name].wait(1.0)
+            self.wakeup[name].clear()
+
+    def boot(self, config, cmd, setup):
+        child, reader = REPL.boot(config, cmd, setup, self.boot_timeout)
+        if child is None:
+            return None
+        return (child, reader.pending)
+
+    def reap(self):
+        with self.lock:
+            self.adopted = [ (name, child) for name, child in self.adopted
+                             if child.poll() is None ]
+
+    def take(self, name, cwd, profile):
+        config = self.configs.get(name)
+        if config is None:
+            return None
+        chdir = cwd != os.getcwd()
+        usable = ((not chdir or config.chdir_cmd is not None)
+                  and profile == self.profile)
+        if name in self.forking:
+            return self.take_fork(name, chdir, usable)
+        entry = None
+        with self.lock:
+            if usable:
+                while self.ready[name]:
+                    child, pending = self.ready[name].popleft()
+                    if child.poll() is None:
+                        entry = (child, pending, chdir)
+                        self.adopted.append((name, child))
+                        break
+            if entry is None:
+                self.stats[name]['misses'] += 1
+            else:
+                self.stats[name]['hits'] += 1
+        self.wakeup[name].set()
+        return entry
+
+    def take_fork(self, name, chdir, usable):
+        # a miss (the kernel starts its own child) if the template is not
+        # up yet, or the fork fails
+        stats = self.stats[name]
+        server = self.servers.get(name)
+        forked = None
+        if usable and server is not None and server.alive():
+            started = time.monotonic()
+            forked = server.fork(self.fork_timeout)
+            latency = time.monotonic() - started
+        with self.lock:
+            if forked is None:
+                stats['misses'] += 1
+            else:
+                stats['hits'] += 1
+                stats['forks'] += 1
+                stats['fork_time'] += latency
+                stats['last_fork_time'] = latency
+                self.adopted.append((name, forked[0]))
+        if forked is None:
+            self.wakeup[name].set()
+            return None
+        child, pending = forked
+        return (child, pending, chdir)
+
+    def record_adoption(self, name, latency):
+        with self.lock:
+            self.stats[name]['adopt_time'] += latency
+            self.stats[name]['last_adopt_time'] = latency
+
+    def get_stats(self):
+        report = {}
+        with self.lock:
+            adopted = list(self.adopted)
+            servers = dict(self.servers)
+        sessions = collections.defaultdict(list)
+        for name, child in adopted:
+            usage = memory_usage(child.pid)
+            if usage is not None:
+                usage['pid'] = child.pid
+                sessions[name].append(usage)
+        with self.lock:
+            for name, stats in self.stats.items():
+                hits, misses = stats['hits'], stats['misses']
+                uss = [ usage['uss'] for usage in sessions[name] ]
+                report[name] = dict(
+                    mode = "fork" if name in self.forking else "ready",
+                    size = self.size,
+                    ready = len(self.ready[name]),
+                    hits = hits,
+                    misses = misses,
+                    hit_rate = (hits / (hits + misses) if hits + misses
+                                else None),
+                    booted = stats['booted'],
+                    failed = stats['failed'],
+                    mean_boot_time = (stats['boot_time'] / stats['booted']
+                                      if stats['booted'] else None),
+                    mean_adopt_time = (stats['adopt_time'] / hits
+                                       if hits else None),
+                    last_adopt_time = stats['last_adopt_time'],
+                    sessions = sessions[name],
+                    mean_session_uss = sum(uss) / len(uss) if uss else None)
+                if name in self.forking:
+                    server = servers.get(name)
+                    report[name].update(
+                        template = (memory_usage(server.child.pid)
+                                    if server is not None else None),
+                        forks = stats['forks'],
+                        mean_fork_time = (stats['fork_time'] / stats['forks']
+                                          if stats['forks'] else None),
+                        last_fork_time = stats['last_fork_time'])
+        return report
+
+
+class PoolHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        pool = self.server.pool
+        creds = self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                        struct.calcsize("3i"))
+        pid, uid, gid = struct.unpack("3i", creds)
+        if uid != os.getuid():
+            return
+        request, fds = recv_message(self.request)
+        if request is None:
+            return
+        if request.get('op') == 'stats':
+            send_message(self.request, pool.get_stats())
+        elif request.get('op') == 'adopt':
+            name = request.get('backend')
+            entry = pool.take(name, request.get('cwd'), request.get('profile'))
+            if entry is None:
+                send_message(self.request, {'pid': None})
+                return
+            child, pending, chdir = entry
+            try:
+                send_message(self.request,
+                             {'pid': child.pid,
+                              'pending': pending,
+                              'chdir': chdir},
+                             [child.stdin.fileno(), child.stdout.fileno()])
+            except OSError:
+                child.kill()
+                return
+            finally:
+                child.stdin.close()
+                child.stdout.close()
+            try:
+                report, fds = recv_message(self.request)
+            except (OSError, ValueError):
+                report = None
+            if report and report.get('op') == 'adopted':
+                pool.record_adoption(name, report['latency'])
+
+
+class PoolServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+###########################################################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m sjk.pool",
+        description="Keep initialized CAS processes ready for sjk kernels "
+                    "started with SJK_POOL_SOCKET set to adopt.")
+    parser.add_argument("backends", nargs="*",
+                        help="backends to pool: {}".format(
+                            ", ".join(sorted(backends.configs))))
+    parser.add_argument("-n", "--size", type=int, default=2,
+                        help="ready processes kept per backend")
+    parser.add_argument("--socket",
+                        default=os.environ.get("SJK_POOL_SOCKET",
+                                               default_socket()))
+    parser.add_argument("--fork", action="store_true",
+                        help="fork sessions from one initialized process "
+                             "instead of keeping ready ones, for the backends "
+                             "that can (gap, with the IO package)")
+    parser.add_argument("--stats", action="store_true",
+                        help="print the statistics of a running pool")
+    args = parser.parse_args(argv)
+
+    if args.stats:
+        print(json.dumps(get_stats(args.socket), indent=2))
+        return
+    for name in args.backends:
+        if name not in backends.configs:
+            parser.error("unknown backend: {}".format(name))
+    if not args.backends:
+        parser.error("no backends given")
+
+    if os.path.exists(args.socket):
+        try:
+            get_stats(args.socket)
+        except OSError:
+            os.unlink(args.socket)
+        else:
+            sys.exit("a pool is already listening on {}".format(args.socket))
+
+    pool = Pool(args.backends, args.size, args.fork)
+    pool.start()
+    umask = os.umask(0o077)
+    server = PoolServer(args.socket, PoolHandler)
+    os.umask(umask)
+    server.pool = pool
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.unlink(args.socket)
+        pool.close()
+
+if __name__ == '__main__':
+    main()
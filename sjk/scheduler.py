@@ -0,0 +1,636 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import pwd
+import select
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+###########################################################################
+
+# A host-local service that the REPLs of sjk kernels started with
+# SJK_SCHEDULER_SOCKET register their CAS processes with. A cell only
+# starts once the scheduler grants it a slot: at most --limit cells of a
+# backend run at a time, and when a slot frees up the waiting cell of the
+# user with the least recent usage gets it. A CAS process idle for long is
+# stopped (SIGSTOP) until its next cell is granted, or terminated; its
+# kernel then starts a new one for the next cell.
+#
+# Each REPL keeps one connection, with JSON lines going both ways:
+#   register {backend, pid}    a new CAS process for the connection
+#   acquire                    answered by queued {position, running,
+#                              limit} if it has to wait, then granted
+#                              {waited}
+#   release                    the cell is done
+#   cancel                     answered by cancelled: the cell was
+#                              interrupted while queued (or running)
+#   stats                      answered by the statistics
+# and the scheduler sends reaped {reason} before terminating an idle CAS.
+# A connection that closes gives its slot back.
+
+def default_socket():
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return os.path.join(runtime, "sjk-scheduler.sock")
+    return os.path.join(tempfile.gettempdir(),
+                        "sjk-scheduler-{}.sock".format(os.getuid()))
+
+def send_message(sock, msg):
+    sock.sendall((json.dumps(msg) + "\n").encode("utf8"))
+
+class Lines(object):
+
+    def __init__(self):
+        self.buffer = b""
+
+    def feed(self, data):
+        # the complete messages received so far
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b"\n")
+        return [ json.loads(line.decode("utf8")) for line in lines if line ]
+
+def user_name(uid):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return str(uid)
+
+def get_stats(path, timeout=5):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        send_message(sock, {'op': 'stats'})
+        lines = Lines()
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError("the scheduler closed the connection")
+            msgs = lines.feed(data)
+            if msgs:
+                return msgs[0]
+    finally:
+        sock.close()
+
+###########################################################################
+
+class SchedulerClient(object):
+
+    # A REPL's connection to the scheduler. If the scheduler goes away,
+    # cells just run.
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.lines = Lines()
+        self.holding = False
+        self.queued = False
+        self.reaped = None
+        # cancels not yet answered: what comes before their answer is stale
+        self.cancelling = 0
+
+    @classmethod
+    def connect(cls, path, timeout=5, blocking=True):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            return None
+        sock.settimeout(None)
+        sock.setblocking(blocking)
+        return cls(sock)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.holding = False
+
+    def send(self, msg):
+        if self.sock is None:
+            return False
+        try:
+            send_message(self.sock, msg)
+        except OSError:
+            self.close()
+            return False
+        return True
+
+    def register(self, backend, pid):
+        self.holding = False
+        self.reaped = None
+        self.send({'op': 'register', 'backend': backend, 'pid': pid})
+
+    def release(self):
+        if self.holding:
+            self.holding = False
+            self.send({'op': 'release'})
+
+    def cancel(self):
+        self.holding = False
+        if self.send({'op': 'cancel'}):
+            self.cancelling += 1
+
+    def receive(self, data, notify):
+        # handles data from the scheduler: the granted message, if it is
+        # there; False once the connection is gone
+        if not data:
+            self.close()
+            return False
+        granted = None
+        for msg in self.lines.feed(data):
+            op = msg.get('op')
+            if op == 'reaped':
+                self.reaped = msg.get('reason')
+            elif op == 'cancelled':
+                self.cancelling -= 1
+            elif self.cancelling:
+                continue
+            elif op == 'queued':
+                self.queued = True
+                notify(msg)
+            elif op == 'granted':
+                self.holding = True
+                granted = msg
+        return granted
+
+    def poll(self):
+        # reads what the scheduler sent unasked; the reason it gave for
+        # terminating the CAS, if it did
+        while (self.sock is not None
+               and select.select([self.sock], [], [], 0)[0]):
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                break
+            except OSError:
+                data = b""
+            self.receive(data, lambda msg: None)
+        return self.reaped
+
+    def acquire(self, notify, control=None, interrupted=None):
+        # waits for a slot, calling notify with the queued message if there
+        # is one; returns the seconds waited, or None if interrupted() said
+        # to give up (it is called when control is ready)
+        self.queued = False
+        if not self.send({'op': 'acquire'}):
+            return 0.0
+        fds = [self.sock] if control is None else [self.sock, control]
+        while True:
+            ready = select.select(fds, [], [])[0]
+            if control in ready and interrupted():
+                self.cancel()
+                return None
+            if self.sock in ready:
+                try:
+                    data = self.sock.recv(65536)
+                except OSError:
+                    data = b""
+                granted = self.receive(data, notify)
+                if granted is False:
+                    return 0.0
+                if granted is not None:
+                    return granted['waited']
+
+    async def acquire_async(self, notify, cancelled):
+        # same, from an event loop on a non-blocking connection; gives up
+        # once the cancelled event is set
+        self.queued = False
+        if not self.send({'op': 'acquire'}):
+            return 0.0
+        loop = asyncio.get_event_loop()
+        stop = asyncio.ensure_future(cancelled.wait())
+        try:
+            while True:
+                recv = asyncio.ensure_future(loop.sock_recv(self.sock, 65536))
+                await asyncio.wait([recv, stop],
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not recv.done():
+                    recv.cancel()
+                    self.cancel()
+                    return None
+                try:
+                    data = recv.result()
+                except OSError:
+                    data = b""
+                granted = self.receive(data, notify)
+                if granted is False:
+                    return 0.0
+                if granted is not None:
+                    return granted['waited']
+        finally:
+            stop.cancel()
+
+###########################################################################
+
+class Session(object):
+
+    # one REPL connection, with the CAS process it registered last
+
+    def __init__(self, sock, uid):
+        self.sock = sock
+        self.uid = uid
+        self.user = user_name(uid)
+        self.backend = None
+        self.pid = None
+        # holding a slot since, or queued as (sequence number, since)
+        self.since = None
+        self.ticket = None
+        self.idle_since = time.monotonic()
+        self.stopped = False
+        self.reaped = False
+        self.send_lock = threading.Lock()
+
+    def send(self, msg):
+        with self.send_lock:
+            try:
+                send_message(self.sock, msg)
+            except OSError:
+                pass
+
+
+class Scheduler(object):
+
+    # Usage is the time a user's cells held slots, decaying by half every
+    # half_life seconds; a free slot goes to the waiting cell whose user
+    # holds fewest slots of that backend, then has the least usage, then
+    # asked first.
+
+    tick = 5
+
+    def __init__(self, limits, default_limit, idle_stop=None, idle_kill=None,
+                 half_life=3600.0):
+        self.limits = limits
+        self.default_limit = default_limit
+        self.idle_stop = idle_stop
+        self.idle_kill = idle_kill
+        self.half_life = half_life
+        self.lock = threading.Lock()
+        self.sessions = set()
+        self.seq = 0
+        self.started = time.monotonic()
+        self.backends = collections.defaultdict(lambda: dict(
+            granted=0, queued=0, wait_time=0.0, max_wait=0.0, stops=0,
+            terminations=0))
+        self.users = collections.defaultdict(lambda: dict(
+            cells=0, busy_time=0.0, wait_time=0.0, usage=0.0,
+            updated=time.monotonic()))
+        self.closed = threading.Event()
+
+    def start(self):
+        reaper = threading.Thread(target=self.reap_idle)
+        reaper.daemon = True
+        reaper.start()
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            # nothing is left stopped
+            self.continue_session(session)
+
+    def limit(self, backend):
+        return self.limits.get(backend, self.default_limit)
+
+    def usage(self, user, now):
+        stats = self.users[user]
+        stats['usage'] *= 0.5 ** ((now - stats['updated']) / self.half_life)
+        stats['updated'] = now
+        return stats['usage']
+
+    def running(self, backend):
+        return [ session for session in self.sessions
+                 if session.backend == backend and session.since is not None ]
+
+    def waiting(self, backend, now):
+        # queued sessions, next one first
+        running = collections.Counter(
+            session.user for session in self.running(backend))
+        return sorted((session for session in self.sessions
+                       if session.backend == backend
+                       and session.ticket is not None),
+                      key=lambda session: (running[session.user],
+                                           self.usage(session.user, now),
+                                           session.ticket[0]))
+
+    def continue_session(self, session):
+        if session.stopped:
+            session.stopped = False
+            try:
+                os.kill(session.pid, signal.SIGCONT)
+            except ProcessLookupError:
+                pass
+
+    def deliver(self, sends):
+        for session, msg in sends:
+            session.send(msg)
+
+    # all of the following return the messages to deliver once the lock
+    # is released
+
+    def register(self, session, backend, pid):
+        try:
+            owner = os.stat("/proc/{}".format(pid)).st_uid
+        except OSError:
+            owner = None
+        if owner != session.uid:
+            sys.stderr.write("sjk.scheduler: {} registered pid {}, which is "
+                             "not theirs\n".format(session.user, pid))
+            return []
+        with self.lock:
+            sends = self.finish(session, time.monotonic())
+            session.backend = backend
+            session.pid = pid
+            session.stopped = False
+            session.reaped = False
+            session.idle_since = time.monotonic()
+            self.sessions.add(session)
+        return sends
+
+    def acquire(self, session):
+        with self.lock:
+            if session not in self.sessions:
+                # unregistered: nothing to schedule
+                return [(session, {'op': 'granted', 'waited': 0.0})]
+            now = time.monotonic()
+            sends = self.finish(session, now)
+            self.seq += 1
+            session.ticket = (self.seq, now)
+            sends.extend(self.dispatch(session.backend, now))
+            if session.ticket is not None:
+                self.backends[session.backend]['queued'] += 1
+                waiting = self.waiting(session.backend, now)
+                sends.append((session, {
+                    'op': 'queued',
+                    'position': waiting.index(session) + 1,
+                    'running': len(self.running(session.backend)),
+                    'limit': self.limit(session.backend)}))
+        return sends
+
+    def release(self, session):
+        with self.lock:
+            return self.finish(session, time.monotonic())
+
+    def cancel(self, session):
+        with self.lock:
+            session.ticket = None
+            sends = self.finish(session, time.monotonic())
+        return sends + [(session, {'op': 'cancelled'})]
+
+    def remove(self, session):
+        with self.lock:
+            session.ticket = None
+            sends = self.finish(session, time.monotonic())
+            self.sessions.discard(session)
+        self.continue_session(session)
+        return sends
+
+    def finish(self, session, now):
+        # gives back the session's slot, if it holds one
+        if session.since is None:
+            return []
+        held = now - session.since
+        stats = self.users[session.user]
+        stats['cells'] += 1
+        stats['busy_time'] += held
+        stats['usage'] = self.usage(session.user, now) + held
+        session.since = None
+        session.idle_since = now
+        return self.dispatch(session.backend, now)
+
+    def dispatch(self, backend, now):
+        # grants the free slots of backend
+        sends = []
+        free = self.limit(backend) - len(self.running(backend))
+        for session in self.waiting(backend, now)[:max(free, 0)]:
+            waited = now - session.ticket[1]
+            session.ticket = None
+            session.since = now
+            self.continue_session(session)
+            stats = self.backends[backend]
+            stats['granted'] += 1
+            stats['wait_time'] += waited
+            stats['max_wait'] = max(stats['max_wait'], waited)
+            self.users[session.user]['wait_time'] += waited
+            sends.append((session, {'op': 'granted', 'waited': waited}))
+        return sends
+
+    def reap_idle(self):
+        while not self.closed.wait(self.tick):
+            stop = []
+            terminate = []
+            with self.lock:
+                now = time.monotonic()
+                for session in self.sessions:
+                    if (session.since is not None or session.ticket is not None
+                            or session.reaped):
+                        continue
+                    idle = now - session.idle_since
+                    if self.idle_kill is not None and idle >= self.idle_kill:
+                        session.reaped = True
+                        terminate.append(session)
+                        self.backends[session.backend]['terminations'] += 1
+                    elif (self.idle_stop is not None and idle >= self.idle_stop
+                            and not session.stopped):
+                        session.stopped = True
+                        stop.append(session)
+                        self.backends[session.backend]['stops'] += 1
+            for session in stop:
+                try:
+                    os.kill(session.pid, signal.SIGSTOP)
+                except ProcessLookupError:
+                    pass
+            for session in terminate:
+                session.send({'op': 'reaped',
+                              'reason': "was terminated by the scheduler "
+                                        "after {:g} s idle".format(
+                                            self.idle_kill)})
+                try:
+                    os.kill(session.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+                self.continue_session(session)
+
+    def get_stats(self):
+        with self.lock:
+            now = time.monotonic()
+            names = set(self.backends) | set(
+                session.backend for session in self.sessions)
+            report = dict(uptime=now - self.started,
+                          idle_stop=self.idle_stop,
+                          idle_kill=self.idle_kill,
+                          backends={}, users={})
+            for name in sorted(names):
+                stats = self.backends[name]
+                waiting = self.waiting(name, now)
+                report['backends'][name] = dict(
+                    limit = self.limit(name),
+                    sessions = sum(1 for session in self.sessions
+                                   if session.backend == name),
+                    running = len(self.running(name)),
+                    queue_depth = len(waiting),
+                    longest_wait = (now - min(session.ticket[1]
+                                              for session in waiting)
+                                    if waiting else None),
+                    stopped = sum(1 for session in self.sessions
+                                  if session.backend == name
+                                  and session.stopped),
+                    granted = stats['granted'],
+                    queued = stats['queued'],
+                    mean_wait = (stats['wait_time'] / stats['granted']
+                                 if stats['granted'] else None),
+                    max_wait = stats['max_wait'],
+                    stops = stats['stops'],
+                    terminations = stats['terminations'])
+            users = set(self.users) | set(
+                session.user for session in self.sessions)
+            for user in sorted(users):
+                stats = self.users[user]
+                report['users'][user] = dict(
+                    sessions = sum(1 for session in self.sessions
+                                   if session.user == user),
+                    running = sum(1 for session in self.sessions
+                                  if session.user == user
+                                  and session.since is not None),
+                    queued = sum(1 for session in self.sessions
+                                 if session.user == user
+                                 and session.ticket is not None),
+                    cells = stats['cells'],
+                    busy_time = stats['busy_time'],
+                    wait_time = stats['wait_time'],
+                    usage = self.usage(user, now))
+        return report
+
+
+class SchedulerHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        scheduler = self.server.scheduler
+        creds = self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                        struct.calcsize("3i"))
+        pid, uid, gid = struct.unpack("3i", creds)
+        if uid != os.getuid() and not self.server.shared:
+            return
+        session = Session(self.request, uid)
+        lines = Lines()
+        try:
+            while True:
+                data = self.request.recv(65536)
+                if not data:
+                    break
+                for msg in lines.feed(data):
+                    self.handle_message(scheduler, session, msg)
+        except (OSError, ValueError):
+            pass
+        finally:
+            scheduler.deliver(scheduler.remove(session))
+
+    def handle_message(self, scheduler, session, msg):
+        op = msg.get('op')
+        if op == 'register':
+            sends = scheduler.register(session, str(msg.get('backend')),
+                                       msg.get('pid'))
+        elif op == 'acquire':
+            sends = scheduler.acquire(session)
+        elif op == 'release':
+            sends = scheduler.release(session)
+        elif op == 'cancel':
+            sends = scheduler.cancel(session)
+        elif op == 'stats':
+            sends = [(session, scheduler.get_stats())]
+        else:
+            sends = []
+        scheduler.deliver(sends)
+
+
+class SchedulerServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+###########################################################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m sjk.scheduler",
+        description="Share this host's cores between the sjk kernels "
+                    "started with SJK_SCHEDULER_SOCKET set.")
+    parser.add_argument("--limit", action="append", default=[],
+                        metavar="BACKEND=N",
+                        help="cells of a backend run at a time (repeatable)")
+    parser.add_argument("--default-limit", type=int, default=os.cpu_count(),
+                        help="the limit for other backends (default: one "
+                             "per core)")
+    parser.add_argument("--idle-stop", type=float, metavar="SECONDS",
+                        help="stop (SIGSTOP) a CAS idle this long, until its "
+                             "next cell")
+    parser.add_argument("--idle-kill", type=float, metavar="SECONDS",
+                        help="terminate a CAS idle this long; its kernel "
+                             "starts a new one for the next cell")
+    parser.add_argument("--half-life", type=float, default=3600.0,
+                        metavar="SECONDS",
+                        help="how fast the usage that fair sharing goes by "
+                             "is forgotten (default: an hour)")
+    parser.add_argument("--shared", action="store_true",
+                        help="let other users connect (run it as root to "
+                             "stop their CAS processes)")
+    parser.add_argument("--socket",
+                        default=os.environ.get("SJK_SCHEDULER_SOCKET",
+                                               default_socket()))
+    parser.add_argument("--stats", action="store_true",
+                        help="print the statistics of a running scheduler")
+    args = parser.parse_args(argv)
+
+    if args.stats:
+        print(json.dumps(get_stats(args.socket), indent=2))
+        return
+    limits = {}
+    for limit in args.limit:
+        name, sep, value = limit.partition("=")
+        try:
+            limits[name] = int(value)
+        except ValueError:
+            parser.error("bad --limit: {} (use BACKEND=N)".format(limit))
+        if limits[name] < 1:
+            parser.error("--limit must be at least 1")
+    if args.default_limit < 1:
+        parser.error("--default-limit must be at least 1")
+
+    if os.path.exists(args.socket):
+        try:
+            get_stats(args.socket)
+        except OSError:
+            os.unlink(args.socket)
+        else:
+            sys.exit("a scheduler is already listening on {}".format(
+                args.socket))
+
+    scheduler = Scheduler(limits, args.default_limit, args.idle_stop,
+                          args.idle_kill, args.half_life)
+    scheduler.start()
+    umask = os.umask(0 if args.shared else 0o077)
+    server = SchedulerServer(args.socket, SchedulerHandler)
+    os.umask(umask)
+    server.scheduler = scheduler
+    server.shared = args.shared
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.unlink(args.socket)
+        scheduler.close()
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@ from .syntax import singular as singular_syntax
 
 class SingularConfig(CasConfig):
 
+    name = "singular"
     prompt_char = "\u2192"
     prompt_cmd = "print(\"{}\");".format(prompt_char)
     cmd = \
@@ -18,6 +19,11 @@ class SingularConfig(CasConfig):
         ]
     initial_input = None
     use_intermediate_file = True
+    interrupt_input = "r\n" + prompt_cmd + "\n" # "abort immediately"
+    chdir_cmd = "system(\"cd\", {});"
+    checkpoint_cmd = "dump(\"ssi:w \" + {});"
+    restore_cmd = "getdump(\"ssi:r \" + {});"
+    list_assign_cmd = "list {name} = {items};"
 
     @classmethod
     def syntaxchecker(cls, code):
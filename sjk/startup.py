@@ -0,0 +1,124 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+###########################################################################
+
+# A startup profile is a preamble of CAS code (SJK_PREAMBLE names the
+# file, usually from a kernelspec's env) run before the first cell. For
+# backends that can save their session (GAP workspaces), the state after
+# the preamble is cached on disk, keyed by the CAS binary and the preamble,
+# and later children start from that image instead of running it again.
+
+image_timeout = 600
+
+def read_preamble():
+    # the preamble, and why it could not be read
+    path = os.environ.get("SJK_PREAMBLE")
+    if not path:
+        return None, None
+    try:
+        with open(os.path.expanduser(path), encoding="utf8") as f:
+            return f.read(), None
+    except OSError as e:
+        return None, "could not read SJK_PREAMBLE {}: {}".format(
+            path, e.strerror)
+
+def load_preamble():
+    preamble, err = read_preamble()
+    if err is not None:
+        sys.stderr.write("sjk: {}\n".format(err))
+    return preamble
+
+def profile_key(preamble=None):
+    if preamble is None:
+        preamble = load_preamble()
+    if preamble is None:
+        return None
+    return hashlib.sha256(preamble.encode("utf8")).hexdigest()
+
+def cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "sjk", "images")
+
+def binary_key(config):
+    path = shutil.which(config.cmd[0])
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    key = hashlib.sha256(
+        "{}:{}:{}".format(path, st.st_size, st.st_mtime_ns).encode("utf8"))
+    if st.st_size < 1 << 20:
+        # wrapper scripts (like GAP's) name the actual installation
+        with open(path, "rb") as f:
+            key.update(f.read())
+    return key.hexdigest()
+
+def image_path(config, preamble):
+    binary = binary_key(config)
+    if binary is None:
+        return None
+    key = json.dumps([config.name, config.cmd, binary, preamble])
+    key = hashlib.sha256(key.encode("utf8")).hexdigest()[:32]
+    return os.path.join(cache_dir(), "{}-{}.image".format(config.name, key))
+
+def prepare(config):
+    # the command to start a child with, and the setup code it still needs
+    if config.restore_image is not None:
+        # a restored checkpoint (see sjk.checkpoint) has the preamble in it
+        args = [ arg.format(config.restore_image)
+                 for arg in config.image_args ]
+        return config.cmd + args, None
+    preamble, err = read_preamble()
+    if err is not None:
+        # said with the first cell; the child starts without it
+        config.restart_notice = "[{}; started without it]\n".format(err)
+    if preamble is None:
+        return config.cmd, None
+    if config.save_image_cmd is not None:
+        image = cached_image(config, preamble)
+        if image is not None:
+            args = [ arg.format(image) for arg in config.image_args ]
+            return config.cmd + args, None
+    return config.cmd, preamble
+
+def cached_image(config, preamble):
+    path = image_path(config, preamble)
+    if path is None:
+        return None
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        # kernels starting together build it only once
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            build_image(config, preamble, path)
+    return path if os.path.exists(path) else None
+
+def build_image(config, preamble, path):
+    from .cas_kernel import REPL
+    child, reader = REPL.boot(config, config.cmd, preamble, image_timeout)
+    if child is None:
+        sys.stderr.write("sjk: could not run the preamble for {}\n".format(
+            config.name))
+        return
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    child.stdin.write("{}\n{}\n".format(
+        config.save_image_cmd.format(json.dumps(tmp)), config.prompt_cmd))
+    child.stdin.flush()
+    REPL.skip_output(reader)
+    child.stdin.close()
+    try:
+        child.wait(image_timeout)
+    except Exception:
+        child.kill()
+        child.wait()
+    if os.path.exists(tmp) and os.path.getsize(tmp) > 0:
+        os.replace(tmp, path)
+    elif os.path.exists(tmp):
+        os.unlink(tmp)
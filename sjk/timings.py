@@ -0,0 +1,156 @@
+import bisect
+import collections
+import os
+import tempfile
+
+###########################################################################
+
+# Where the time of a cell goes, stage by stage. The kernel and the REPL
+# each take monotonic timestamps (the clock is the same in both processes)
+# as a cell goes through them; stage_durations turns them into seconds per
+# stage, which go into a histogram per stage and into a short list of the
+# last cells, for %timings and the Prometheus text file.
+
+stages = [
+    ('zmq',         "from the client's request to the kernel (by the "
+                    "request's date)"),
+    ('shell_queue', "waiting in the kernel behind earlier requests"),
+    ('to_repl',     "from the kernel to the CAS driver; pipelined cells "
+                    "wait there for the previous one"),
+    ('syntax',      "syntax check"),
+    ('prepare',     "input command and intermediate file"),
+    ('admission',   "waiting for the scheduler"),
+    ('compute',     "the CAS, from the cell written to its prompt back, "
+                    "less scan"),
+    ('scan',        "scanning the CAS output"),
+    ('finish',      "collecting the outputs in the driver"),
+    ('from_repl',   "from the CAS driver to the kernel"),
+    ('publish',     "building and sending the IOPub messages"),
+    ('total',       "from the request's arrival to the reply"),
+]
+
+# upper bounds of the histogram buckets, in seconds
+buckets = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0]
+
+def stage_durations(kernel, repl):
+    # seconds per stage, from the kernel's and the REPL's timestamps (either
+    # may lack some); stages with a missing end are left out
+    times = dict(repl or {}, **kernel)
+    spans = {
+        'shell_queue': ('arrived', 'started'),
+        'to_repl':     ('submitted', 'dequeued'),
+        'syntax':      ('dequeued', 'checked'),
+        'prepare':     ('checked', 'prepared'),
+        'admission':   ('prepared', 'written'),
+        'compute':     ('written', 'prompt'),
+        'finish':      ('prompt', 'finished'),
+        'from_repl':   ('finished', 'received'),
+        'publish':     ('received', 'published'),
+        'total':       ('arrived', 'ended'),
+    }
+    durations = {}
+    for stage, (start, end) in spans.items():
+        if times.get(start) is not None and times.get(end) is not None:
+            durations[stage] = max(0.0, times[end] - times[start])
+    if 'scan' in times and 'compute' in durations:
+        durations['scan'] = times['scan']
+        durations['compute'] = max(0.0, durations['compute'] - times['scan'])
+    if times.get('sent') is not None and times.get('arrived_wall') is not None:
+        durations['zmq'] = max(0.0, times['arrived_wall'] - times['sent'])
+    return durations
+
+###########################################################################
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # the upper bound of the bucket holding quantile q
+        if not self.count:
+            return None
+        seen = 0
+        for n, count in enumerate(self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return buckets[n] if n < len(buckets) else float("inf")
+
+
+class StageTimings(object):
+
+    def __init__(self, keep=100):
+        self.histograms = { stage: Histogram() for stage, help in stages }
+        self.recent = collections.deque(maxlen=keep)
+
+    def record(self, cell, durations):
+        for stage, seconds in durations.items():
+            self.histograms[stage].observe(seconds)
+        self.recent.append((cell, durations))
+
+    def breakdown(self, count):
+        # the last count cells, a column per stage, in milliseconds
+        names = [ stage for stage, help in stages
+                  if any(stage in durations
+                         for cell, durations in self.recent) ]
+        width = max(9, max(len(name) for name in names) + 1)
+        lines = ["{:>6}".format("cell")
+                 + "".join("{:>{}}".format(name, width) for name in names)]
+        for cell, durations in list(self.recent)[-count:]:
+            lines.append("{:>6}".format(cell) + "".join(
+                "{:>{}.2f}".format(durations[name] * 1000, width)
+                if name in durations else "{:>{}}".format("-", width)
+                for name in names))
+        histograms = [ self.histograms[name] for name in names ]
+        lines.append("{:>6}".format("mean") + "".join(
+            "{:>{}.2f}".format(h.sum / h.count * 1000, width)
+            for h in histograms))
+        lines.append("{:>6}".format("p90<=") + "".join(
+            "{:>{}g}".format(h.quantile(0.9) * 1000, width)
+            for h in histograms))
+        lines.append("milliseconds; mean and 90th percentile bucket over {} "
+                     "cells".format(self.histograms['total'].count))
+        return "\n".join(lines)
+
+    def prometheus(self, labels):
+        labels = ",".join('{}="{}"'.format(key, value)
+                          for key, value in sorted(labels.items()))
+        lines = ["# HELP sjk_cell_stage_seconds Time cells spent in each "
+                 "stage of the kernel",
+                 "# TYPE sjk_cell_stage_seconds histogram"]
+        for stage, help in stages:
+            histogram = self.histograms[stage]
+            if not histogram.count:
+                continue
+            stage_labels = '{},stage="{}"'.format(labels, stage)
+            seen = 0
+            for bound, count in zip(buckets + ["+Inf"], histogram.counts):
+                seen += count
+                lines.append('sjk_cell_stage_seconds_bucket{{{},le="{}"}} {}'
+                             .format(stage_labels, bound, seen))
+            lines.append("sjk_cell_stage_seconds_sum{{{}}} {}".format(
+                stage_labels, histogram.sum))
+            lines.append("sjk_cell_stage_seconds_count{{{}}} {}".format(
+                stage_labels, histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, labels):
+        # atomically, for a collector that may read it at any time
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(prefix=".sjk-", dir=directory)
+        try:
+            with open(fd, "w") as f:
+                f.write(self.prometheus(labels))
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
@@ -0,0 +1,88 @@
+import os
+import time
+
+from .checkpoint import format_size
+
+###########################################################################
+
+# What a cell cost the CAS, from /proc/<pid>: the REPL samples the child
+# as it writes the cell and again once its prompt is back. CPU time counts
+# the child's waited-for subprocesses too; the peak is the high water mark
+# of resident memory, which is reset at the start of each cell (through
+# clear_refs) where the kernel may; read and write are bytes of storage
+# I/O, when /proc/<pid>/io can be read.
+
+clock_ticks = os.sysconf("SC_CLK_TCK")
+
+def sample(pid):
+    # None once the child is gone
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            stat = f.read()
+        with open("/proc/{}/status".format(pid)) as f:
+            status = f.read()
+    except OSError:
+        return None
+    # the command name may hold spaces and parentheses
+    fields = stat[stat.rindex(")") + 2:].split()
+    # in clock ticks
+    info = {
+        'user': int(fields[11]) + int(fields[13]),
+        'sys': int(fields[12]) + int(fields[14]),
+    }
+    for line in status.splitlines():
+        key, sep, value = line.partition(":")
+        if key in ("VmHWM", "VmRSS"):
+            info[key] = int(value.split()[0]) * 1024
+    try:
+        with open("/proc/{}/io".format(pid)) as f:
+            for line in f:
+                key, sep, value = line.partition(":")
+                if key in ("read_bytes", "write_bytes"):
+                    info[key] = int(value)
+    except OSError:
+        pass
+    return info
+
+def start(pid):
+    try:
+        with open("/proc/{}/clear_refs".format(pid), "w") as f:
+            f.write("5")
+        reset = True
+    except OSError:
+        reset = False
+    return pid, time.monotonic(), reset, sample(pid)
+
+def finish(started):
+    # the cell's usage, from what start returned; None if it cannot tell
+    pid, since, reset, first = started
+    wall = time.monotonic() - since
+    last = sample(pid)
+    if first is None or last is None:
+        return None
+    usage = {
+        'wall': wall,
+        'cpu': (last['user'] + last['sys'] - first['user'] - first['sys'])
+               / clock_ticks,
+        'user': (last['user'] - first['user']) / clock_ticks,
+        'sys': (last['sys'] - first['sys']) / clock_ticks,
+        'peak_rss': last.get('VmHWM'),
+        'rss': last.get('VmRSS'),
+        # without the reset, the peak is since the child started
+        'peak_since_start': not reset,
+    }
+    for key in ("read_bytes", "write_bytes"):
+        if key in first and key in last:
+            usage[key] = last[key] - first[key]
+    return usage
+
+def footer(usage):
+    parts = ["cpu {:.2f} s".format(usage['cpu']),
+             "wall {:.2f} s".format(usage['wall'])]
+    if usage.get('peak_rss') is not None:
+        parts.append("peak {}".format(format_size(usage['peak_rss'])))
+    if usage.get('read_bytes') or usage.get('write_bytes'):
+        parts.append("io {} in, {} out".format(
+            format_size(usage['read_bytes']),
+            format_size(usage['write_bytes'])))
+    return "[{}]\n".format(", ".join(parts))